@@ -0,0 +1,109 @@
+# SPDX-FileCopyrightText: 2022 Markus Kowalewski
+#
+# SPDX-License-Identifier: GPL-3.0-only
+
+'''Benchmark chunked storage
+
+Imports a series of versions of a synthetic file into a plain and a chunked
+data store. Every version appends a few frames to the previous one and
+modifies a small region in the middle, like a growing trajectory file.
+Reports import throughput and the space used by both stores. Exits with
+an error if chunked imports are slower than --min-rate.
+
+usage: python benchmarks/bench_chunking.py [--size MiB] [--versions N] [--min-rate MiB/s]
+'''
+
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+import contextlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from fspx import cas
+from fspx import chunking
+
+
+def store_size(path: str) -> int:
+    size = 0
+    for root, _, files in os.walk(path):
+        if os.path.basename(root) in [ "tmp", "meta" ]:
+            continue
+        for f in files:
+            size = size + os.lstat(os.path.join(root, f)).st_size
+
+    return size
+
+def make_versions(dir: str, size: int, versions: int, frame: int) -> list[str]:
+    rng = random.Random(0)
+    data = bytearray(rng.randbytes(size))
+
+    paths = []
+    for v in range(versions):
+        path = os.path.join(dir, "version-{}".format(v))
+        with open(path, "wb") as f:
+            f.write(data)
+        paths.append(path)
+
+        # append frames and modify a few bytes somewhere in the middle
+        data += rng.randbytes(frame)
+        pos = rng.randrange(len(data) // 2, len(data))
+        data[pos:pos] = rng.randbytes(rng.randrange(1, 100))
+
+    return paths
+
+def import_all(paths: list[str], dstore: str) -> float:
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(None):
+        for p in paths:
+            cas.copy_to_store(p, dstore)
+
+    return time.perf_counter() - start
+
+def main():
+    args = argparse.ArgumentParser(description="Benchmark chunked storage")
+    args.add_argument("--size", type=int, default=64, help="Size of the first version in MiB")
+    args.add_argument("--versions", type=int, default=4, help="Number of versions")
+    args.add_argument("--frame", type=int, default=1, help="Size appended per version in MiB")
+    args.add_argument("--min-rate", type=float, default=50, help="Minimum throughput of chunked imports in MiB/s")
+    args = args.parse_args()
+
+    if not chunking.have_numpy():
+        print("numpy is not available, chunking falls back to pure Python")
+
+    rates = {}
+
+    with tempfile.TemporaryDirectory() as dir:
+        paths = make_versions(dir, args.size << 20, args.versions, args.frame << 20)
+        logical = sum(os.path.getsize(p) for p in paths)
+
+        plain = os.path.join(dir, "plain")
+        chunked = os.path.join(dir, "chunked")
+        os.makedirs(plain)
+        cas.set_chunk_threshold(chunked, 0)
+
+        print("{:<10} {:>12} {:>12} {:>10}".format("store", "stored [MiB]", "MiB/s", "dedup"))
+        for name, dstore in [ ("plain", plain), ("chunked", chunked) ]:
+            elapsed = import_all(paths, dstore)
+            size = store_size(dstore)
+            rates[name] = logical / (1 << 20) / elapsed
+            print("{:<10} {:>12.1f} {:>12.1f} {:>9.2f}x".format(
+                name, size / (1 << 20), logical / (1 << 20) / elapsed, logical / size))
+
+        start = time.perf_counter()
+        for p in paths:
+            os.remove(cas.materialize(cas.hash_file(p), chunked))
+        elapsed = time.perf_counter() - start
+        print("Reassembled {:.1f} MiB at {:.1f} MiB/s (incl. hashing of the originals)".format(
+            logical / (1 << 20), logical / (1 << 20) / elapsed))
+
+    if rates["chunked"] < args.min_rate:
+        print("Chunked import at {:.1f} MiB/s is below the minimum of {:.1f} MiB/s".format(rates["chunked"], args.min_rate))
+        exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+# SPDX-FileCopyrightText: 2022 Markus Kowalewski
+#
+# SPDX-License-Identifier: GPL-3.0-only
+
+'''Micro-benchmark for file hashing
+
+Compares the streaming cas.hash_file against reading the whole
+file into memory (the previous implementation) and an mmap variant.
+Every implementation runs in a fresh process, so that peak RSS
+can be reported per implementation.
+
+usage: python benchmarks/bench_hash.py [--size MiB] [--file path]
+'''
+
+import os
+import sys
+import time
+import mmap
+import hashlib
+import argparse
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from fspx import cas
+
+
+def hash_read_all(path: str) -> str:
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+def hash_mmap(path: str) -> str:
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return hashlib.sha256().hexdigest()
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            return hashlib.sha256(m).hexdigest()
+
+def hash_readinto(path: str) -> str:
+    with open(path, "rb", buffering=0) as f:
+        return cas.hash_stream(f)
+
+impls = {
+    "read-all": hash_read_all,
+    "mmap": hash_mmap,
+    "readinto": hash_readinto,
+    "cas.hash_file": cas.hash_file,
+}
+
+def run_child(impl: str, path: str) -> tuple[str, float, int]:
+    '''Run one implementation in a child process
+
+        return: hash, wall time, peak RSS in KiB
+    '''
+    start = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, __file__, "--child", impl, "--file", path],
+                            stdout=subprocess.PIPE)
+    out = proc.stdout.read().decode().strip()
+    proc.stdout.close()
+    _, _, rusage = os.wait4(proc.pid, 0)
+    elapsed = time.perf_counter() - start
+
+    return out, elapsed, rusage.ru_maxrss
+
+def create_file(path: str, size: int) -> None:
+    block = os.urandom(cas.BLOCK_SIZE)
+    with open(path, "wb") as f:
+        for _ in range(size // len(block)):
+            f.write(block)
+        f.write(block[:size % len(block)])
+
+def main():
+    args = argparse.ArgumentParser(description="Benchmark file hashing")
+    args.add_argument("--size", type=int, default=1024, help="Size of the test file in MiB")
+    args.add_argument("--file", help="Use an existing file instead of a generated one")
+    args.add_argument("--child", help=argparse.SUPPRESS)
+    args = args.parse_args()
+
+    if args.child:
+        print(impls[args.child](args.file))
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = args.file
+        if path is None:
+            path = os.path.join(tmp, "data")
+            create_file(path, args.size << 20)
+
+        size = os.path.getsize(path)
+        print("File size: {:.2f} GiB".format(size / (1 << 30)))
+        print("{:<16} {:>10} {:>10} {:>14}".format("impl", "time [s]", "GB/s", "peak RSS [MiB]"))
+
+        reference = None
+        for impl in impls:
+            hash, elapsed, maxrss = run_child(impl, path)
+            if reference is None:
+                reference = hash
+            elif hash != reference:
+                print("Hash mismatch for {}!".format(impl))
+                exit(1)
+
+            print("{:<16} {:>10.3f} {:>10.3f} {:>14.1f}".format(impl, elapsed, size / elapsed / 1e9, maxrss / 1024))
+
+
+if __name__ == '__main__':
+    main()
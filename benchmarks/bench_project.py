@@ -0,0 +1,152 @@
+# SPDX-FileCopyrightText: 2022 Markus Kowalewski
+#
+# SPDX-License-Identifier: GPL-3.0-only
+
+'''End-to-end benchmark on a synthetic project
+
+Generates a project with benchmarks/genproject.py and times the phases
+check (before and after running), run, store-import, store-check,
+store-gc and export. Every phase runs fspx in a fresh process, so that
+peak RSS can be reported per phase. Nix is not needed, a stand-in for
+nix-store is placed in the project.
+
+Results can be saved as JSON and compared against a previous result:
+
+    python benchmarks/bench_project.py --jobs 200 --shape diamond -o new.json --compare old.json
+
+usage: python benchmarks/bench_project.py [options]
+'''
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+import genproject
+
+
+REPO = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+def run_fspx(project: str, args: list[str]) -> tuple[int, float, int]:
+    """Run fspx in project
+
+        return: exit code, wall time in seconds, peak RSS in KiB
+    """
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [ REPO, env.get('PYTHONPATH') ]))
+    env['PATH'] = os.pathsep.join([ os.path.join(project, "bin"), env.get('PATH', "") ])
+
+    start = time.perf_counter()
+    proc = subprocess.Popen([ sys.executable, "-m", "fspx.main" ] + args, cwd=project, env=env,
+                            stdout=subprocess.DEVNULL)
+    _, status, rusage = os.wait4(proc.pid, 0)
+    elapsed = time.perf_counter() - start
+
+    return os.waitstatus_to_exitcode(status), elapsed, rusage.ru_maxrss
+
+def phases(project: str, max_jobs: int) -> list[tuple[str, list[str], int]]:
+    """Phases with fspx arguments and the expected exit code
+    """
+    dstore = os.path.join(project, "dstore")
+    export = os.path.join(project, "export")
+
+    return [
+        ("check (cold)", [ "check" ], 1),
+        ("run", [ "run", "-j", str(max_jobs) ], 0),
+        ("check (warm)", [ "check" ], 0),
+        ("store-import", [ "store-import", "src/extra.dat", "extra" ], 0),
+        ("store-check", [ "store-check", dstore ], 0),
+        ("store-gc", [ "store-gc", dstore ], 0),
+        ("export", [ "export", export, os.path.join(export, "dstore") ], 0),
+    ]
+
+def benchmark(project: str, args) -> list[dict]:
+    genproject.generate(project, args.shape, args.jobs, args.inputs, args.outputs,
+                        args.input_size << 10, args.output_size << 10)
+
+    # extra file for store-import, removed again before store-gc
+    with open(os.path.join(project, "src", "extra.dat"), "wb") as f:
+        f.write(os.urandom(args.input_size << 10))
+
+    results = []
+    for name, cmd, expected in phases(project, args.max_jobs):
+        if name == "store-gc":
+            os.remove(os.path.join(project, "extra"))
+
+        ret, elapsed, rss = run_fspx(project, cmd)
+        if ret != expected:
+            raise Exception("Phase {} exited with {}, expected {}".format(name, ret, expected))
+
+        results.append({ 'phase': name, 'time': elapsed, 'maxrss': rss })
+        print("{:<14} {:>10.3f} {:>14.1f}".format(name, elapsed, rss / 1024))
+
+    return results
+
+def compare(results: list[dict], old: dict) -> None:
+    """Print the relative change against a previous result
+    """
+    old = { r['phase']: r for r in old['results'] }
+
+    print("\n{:<14} {:>10} {:>14}".format("phase", "time", "peak RSS"))
+    for r in results:
+        o = old.get(r['phase'])
+        if o == None:
+            continue
+        print("{:<14} {:>+9.1f}% {:>+13.1f}%".format(r['phase'],
+              100 * (r['time'] / o['time'] - 1), 100 * (r['maxrss'] / o['maxrss'] - 1)))
+
+def main():
+    args = argparse.ArgumentParser(description="Benchmark fspx on a synthetic project")
+    args.add_argument("--shape", choices=genproject.SHAPES, default="chain", help="Shape of the job graph")
+    args.add_argument("--jobs", type=int, default=50, help="Number of jobs")
+    args.add_argument("--inputs", type=int, default=1, help="Raw input files per job without dependencies")
+    args.add_argument("--outputs", type=int, default=2, help="Output files per job")
+    args.add_argument("--input-size", type=int, default=1024, help="Size of an input file in KiB")
+    args.add_argument("--output-size", type=int, default=256, help="Size of an output file in KiB")
+    args.add_argument("--max-jobs", type=int, default=1, help="Number of jobs to run concurrently")
+    args.add_argument("--dir", help="Create the project here and keep it, instead of a temporary directory")
+    args.add_argument("-o", "--output", help="Save the results as JSON")
+    args.add_argument("--compare", help="Compare against results saved with -o")
+    args = args.parse_args()
+
+    if args.dir != None:
+        if os.path.exists(args.dir):
+            raise Exception("{} exists already".format(args.dir))
+        project = args.dir
+    else:
+        tmp = tempfile.mkdtemp()
+        project = os.path.join(tmp, "project")
+
+    print("{:<14} {:>10} {:>14}".format("phase", "time [s]", "peak RSS [MiB]"))
+    try:
+        results = benchmark(os.path.abspath(project), args)
+    finally:
+        if args.dir == None:
+            shutil.rmtree(tmp)
+
+    report = {
+        'date': time.strftime("%Y-%m-%dT%H:%M:%S"),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'params': { k: v for k, v in vars(args).items() if not k in [ "dir", "output", "compare" ] },
+        'results': results,
+    }
+
+    if args.output != None:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare != None:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
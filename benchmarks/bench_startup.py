@@ -0,0 +1,64 @@
+# SPDX-FileCopyrightText: 2022 Markus Kowalewski
+#
+# SPDX-License-Identifier: GPL-3.0-only
+
+'''Benchmark job start-up latency
+
+Compares the nix-shell based runScript with the directScript, which sources
+the environment realized by fspx build. Both scripts are called with the
+launcher "true", so the job script itself is not run and only the
+start-up overhead is measured.
+
+Run from the top level directory of a project after fspx build.
+
+usage: python benchmarks/bench_startup.py [--repeat N] [job ...]
+'''
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from fspx import utils
+from fspx import fspx
+
+
+def time_script(script: str, workdir: str, repeat: int) -> list[float]:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([script, workdir, "true"], check=True, stdout=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+
+    return times
+
+def main():
+    args = argparse.ArgumentParser(description="Benchmark job start-up latency")
+    args.add_argument("--repeat", type=int, default=5, help="Number of start-ups per job and script")
+    args.add_argument("jobs", nargs='*', help="Jobs to measure, default: all")
+    args = args.parse_args()
+
+    config = utils.read_json(os.path.join(fspx.cfgPath, "cfg/project.json"))
+    jobs = args.jobs or list(config['jobsets'])
+
+    print("{:<24} {:>14} {:>14} {:>10}".format("job", "nix-shell [s]", "direct [s]", "speedup"))
+
+    with tempfile.TemporaryDirectory() as workdir:
+        for name in jobs:
+            job = config['jobsets'][name]
+            if not 'directScript' in job:
+                print("{:<24} no directScript, rebuild the project with fspx build".format(name))
+                continue
+
+            shell = min(time_script(job['runScript'], workdir, args.repeat))
+            direct = min(time_script(job['directScript'], workdir, args.repeat))
+
+            print("{:<24} {:>14.3f} {:>14.3f} {:>9.1f}x".format(name, shell, direct, shell / direct))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,171 @@
+# SPDX-FileCopyrightText: 2022 Markus Kowalewski
+#
+# SPDX-License-Identifier: GPL-3.0-only
+
+'''Generate a synthetic fspx project without Nix
+
+Writes .fspx/cfg/project.json directly, together with stub run, job and
+check scripts, raw input files and a stand-in for nix-store (bin/nix-store),
+which is sufficient for fspx export.
+
+Shapes of the job graph:
+
+    chain    every job depends on the previous one
+    fanout   one job produces the input of all others
+    diamond  chained diamonds: a job, two jobs using its outputs,
+             and a job joining both
+
+Job outputs are pseudo-random, but deterministic for given inputs.
+
+usage: python benchmarks/genproject.py [options] DIR
+'''
+
+import os
+import sys
+import json
+import random
+import argparse
+
+
+SHAPES = [ "chain", "fanout", "diamond" ]
+
+def dependencies(shape: str, n: int) -> list[list[int]]:
+    """Direct dependencies of the jobs 0..n-1
+    """
+    if shape == "chain":
+        return [ [] ] + [ [ i - 1 ] for i in range(1, n) ]
+
+    if shape == "fanout":
+        return [ [] ] + [ [ 0 ] for _ in range(1, n) ]
+
+    if shape == "diamond":
+        # 0 -> 1, 2 -> 3 -> 4, 5 -> 6 ...
+        deps = [ [] ]
+        for i in range(1, n):
+            pos = (i - 1) % 3
+            top = i - 1 - pos
+            deps.append([ top ] if pos < 2 else [ i - 2, i - 1 ])
+        return deps
+
+    raise Exception("Unknown shape {}".format(shape))
+
+def write_script(path: str, body: str) -> str:
+    with open(path, "w") as f:
+        f.write("#!/bin/sh\n" + body)
+    os.chmod(path, 0o755)
+
+    return path
+
+def write_random(path: str, size: int, rng: random.Random) -> None:
+    with open(path, "wb") as f:
+        while size > 0:
+            n = min(size, 1 << 20)
+            f.write(rng.randbytes(n))
+            size = size - n
+
+def generate(root: str, shape: str = "chain", jobs: int = 10, inputs: int = 1, outputs: int = 1,
+             input_size: int = 1 << 20, output_size: int = 1 << 20, seed: int = 0) -> dict:
+    """Create a project in root
+
+        inputs, outputs: number of raw input files per job without dependencies,
+                         number of output files per job
+        input_size, output_size: size of every file in bytes
+
+        return: project configuration
+    """
+    root = os.path.abspath(root)
+    rng = random.Random(seed)
+
+    for d in [ ".fspx/cfg", "src", "scripts", "bin" ]:
+        os.makedirs(os.path.join(root, d), exist_ok=True)
+
+    scripts = os.path.join(root, "scripts")
+
+    check = write_script(os.path.join(scripts, "check"),
+                         'cd "$1"; shift\nfor f in "$@"; do [ -f "$f" ] || exit 1; done\n')
+
+    # writes every output with bytes seeded by the inputs and its name
+    write_script(os.path.join(scripts, "produce"),
+                 'exec {} -c \'\n'
+                 'import sys, glob, random, hashlib\n'
+                 'size = int(sys.argv[1])\n'
+                 'h = hashlib.sha256()\n'
+                 'for p in sorted(glob.glob("inputs/*")):\n'
+                 '    h.update(open(p, "rb").read())\n'
+                 'for out in sys.argv[2:]:\n'
+                 '    rng = random.Random(h.hexdigest() + out)\n'
+                 '    open(out, "wb").write(rng.randbytes(size))\n'
+                 '\' "$@"\n'.format(sys.executable))
+
+    # stand-in for nix-store, used by fspx export
+    write_script(os.path.join(root, "bin", "nix-store"),
+                 'case "$1" in\n'
+                 '  -qR) shift; for p in "$@"; do echo "$p"; done ;;\n'
+                 '  --export) cat "$2" ;;\n'
+                 'esac\n')
+
+    deps = dependencies(shape, jobs)
+    names = [ "job{:04d}".format(i) for i in range(jobs) ]
+    jobsets = {}
+
+    for i, name in enumerate(names):
+        job_inputs = {}
+        if not deps[i]:
+            for k in range(inputs):
+                file = "src/{}-{}.dat".format(name, k)
+                write_random(os.path.join(root, file), input_size, rng)
+                job_inputs[file] = None
+
+        for d in deps[i]:
+            for out in jobsets[names[d]]['outputs']:
+                job_inputs[":" + out] = None
+
+        job_outputs = [ "{}-{}.out".format(name, k) for k in range(outputs) ]
+
+        job_script = write_script(os.path.join(scripts, "job-" + name),
+                                  '{} {} {}\n'.format(os.path.join(scripts, "produce"), output_size, " ".join(job_outputs)))
+        run_script = write_script(os.path.join(scripts, "run-" + name), 'cd "$1"\n$2 {}\n'.format(job_script))
+
+        jobsets[name] = {
+            'inputs': job_inputs,
+            'outputs': job_outputs,
+            'env': "",
+            'jobLauncher': "",
+            'jobScript': job_script,
+            'runScript': run_script,
+            'checkScript': check,
+            'workdir': os.path.join(root, "work", name),
+            'description': "",
+        }
+
+    config = {
+        'workdir': os.path.join(root, "work"),
+        'dstore': "./dstore",
+        'description': "Synthetic {} project with {} jobs".format(shape, jobs),
+        'jobsets': jobsets,
+        'graph': { names[i]: sorted(names[d] for d in deps[i]) for i in range(jobs) },
+    }
+
+    with open(os.path.join(root, ".fspx", "cfg", "project.json"), "w") as f:
+        json.dump(config, f, indent=2)
+
+    return config
+
+def main():
+    args = argparse.ArgumentParser(description="Generate a synthetic fspx project")
+    args.add_argument("dir", help="Project directory")
+    args.add_argument("--shape", choices=SHAPES, default="chain", help="Shape of the job graph")
+    args.add_argument("--jobs", type=int, default=10, help="Number of jobs")
+    args.add_argument("--inputs", type=int, default=1, help="Raw input files per job without dependencies")
+    args.add_argument("--outputs", type=int, default=1, help="Output files per job")
+    args.add_argument("--input-size", type=int, default=1024, help="Size of an input file in KiB")
+    args.add_argument("--output-size", type=int, default=1024, help="Size of an output file in KiB")
+    args.add_argument("--seed", type=int, default=0, help="Seed for the raw inputs")
+    args = args.parse_args()
+
+    generate(args.dir, args.shape, args.jobs, args.inputs, args.outputs,
+             args.input_size << 10, args.output_size << 10, args.seed)
+
+
+if __name__ == '__main__':
+    main()
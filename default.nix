@@ -12,6 +12,8 @@ python3.pkgs.buildPythonApplication {
   version = "0.1";
   src = ./.;
 
+  propagatedBuildInputs = with python3.pkgs; [ numpy ];
+
   postPatch = ''
     substituteInPlace fspx/main.py --replace \
 	'instDir = "nix/"' "instDir = \"$out/share/fspx/nix\""
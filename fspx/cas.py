@@ -3,24 +3,299 @@
 # SPDX-License-Identifier: GPL-3.0-only
 
 import os
+import stat
+import time
+import shutil
+import errno
+import random
 import hashlib
 import base64
+import json
+import lzma
+import gzip
+import zlib
+import threading
+import concurrent.futures
 
+from . import utils
+from . import chunking
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+# Size of the buffer used to stream files through the hash
+BLOCK_SIZE = 1 << 20
+
+# ioctl to clone a file (linux/fs.h)
+FICLONE = 0x40049409
+
+# Errors indicating that a copy method is not supported for a pair of files
+COPY_FALLBACK_ERRNOS = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EBADF)
+
+# Bytes hashed and copied, counted per thread
+_io = threading.local()
+
+def io_counters() -> dict[str, int]:
+    """Bytes hashed and copied by the calling thread
+    """
+    if not hasattr(_io, "counters"):
+        _io.counters = { 'hashed': 0, 'copied': 0 }
+
+    return _io.counters
+
+def _count(kind: str, n: int) -> None:
+    io_counters()[kind] += n
 
 def hash_file(path: str) -> str:
     """Calculate the sha256 of a file
+
+    The file is streamed through the hash in fixed size blocks,
+    memory usage does not depend on the file size.
     """
-    with open(path, "rb") as f:
-        bytes = f.read()
-        return hash_data(bytes)
+    with open(path, "rb", buffering=0) as f:
+        if hasattr(hashlib, "file_digest"):
+            _count('hashed', os.fstat(f.fileno()).st_size)
+            return hashlib.file_digest(f, "sha256").hexdigest()
+
+        return hash_stream(f)
+
+def hash_stream(f) -> str:
+    """Calculate the sha256 of a binary stream
+
+    A single buffer is reused for all reads.
+    """
+    sha256 = hashlib.sha256()
+    buf = bytearray(BLOCK_SIZE)
+    view = memoryview(buf)
+
+    while True:
+        n = f.readinto(buf)
+        if not n:
+            break
+        sha256.update(view[:n])
+        _count('hashed', n)
+
+    return sha256.hexdigest()
 
 def hash_data(bytes) -> str:
+    _count('hashed', len(bytes))
     return hashlib.sha256(bytes).hexdigest()
 
+#
+# Store layout
+#
+# flat:    <dstore>/<hash>,       <dstore>/gcroots/<hash>/
+# sharded: <dstore>/ab/cd/<hash>, <dstore>/gcroots/ab/cd/<hash>/
+#
+# The layout is recorded in <dstore>/meta/format. Stores without
+# this file are flat. Lookups fall back to the other layout, so a store
+# stays readable while it is being migrated.
+#
+
+FORMAT_FLAT = 1
+FORMAT_SHARDED = 2
+
+LAYOUTS = { "flat": FORMAT_FLAT, "sharded": FORMAT_SHARDED }
+
+# Cache of store formats, dstore -> format
+_formats = {}
+
+def meta_dir(dstore: str) -> str:
+    """Directory for store metadata (not part of the content addressed files)
+    """
+    return os.path.join(dstore, "meta")
+
+def store_format(dstore: str) -> int:
+    """Read the layout version of a store
+    """
+    if dstore not in _formats:
+        try:
+            with open(os.path.join(meta_dir(dstore), "format")) as f:
+                _formats[dstore] = int(f.read())
+        except FileNotFoundError:
+            _formats[dstore] = FORMAT_FLAT
+
+        if _formats[dstore] not in LAYOUTS.values():
+            raise Exception("Unsupported format {} of data store {}".format(_formats[dstore], dstore))
+
+    return _formats[dstore]
+
+def set_store_format(dstore: str, format: int) -> None:
+    os.makedirs(meta_dir(dstore), exist_ok=True)
+    with open(os.path.join(meta_dir(dstore), "format"), "w") as f:
+        f.write("{}\n".format(format))
+
+    _formats[dstore] = format
+
+def _layout_path(base: str, hash: str, format: int) -> str:
+    if format == FORMAT_SHARDED:
+        return os.path.join(base, hash[0:2], hash[2:4], hash)
+
+    return os.path.join(base, hash)
+
+def _lookup(base: str, hash: str, dstore: str) -> str:
+    path = _layout_path(base, hash, store_format(dstore))
+    if os.path.lexists(path):
+        return path
+
+    for format in LAYOUTS.values():
+        other = _layout_path(base, hash, format)
+        if os.path.lexists(other):
+            return other
+
+    return path
+
+def object_path(hash: str, dstore: str) -> str:
+    """Path of a store file. Points to the preferred location if the file does not exist
+    """
+    return _lookup(dstore, hash, dstore)
+
+def gcroot_path(hash: str, dstore: str) -> str:
+    """Path of the gc root directory of a store file
+    """
+    return _lookup(os.path.join(dstore, "gcroots"), hash, dstore)
+
+def _scan_layout(base: str):
+    """Iterate over all entries in base and its shard directories
+    """
+    for entry in os.scandir(base):
+        if len(entry.name) == 2 and entry.is_dir(follow_symlinks=False):
+            for shard in os.scandir(entry.path):
+                if len(shard.name) == 2 and shard.is_dir(follow_symlinks=False):
+                    yield from os.scandir(shard.path)
+        else:
+            yield entry
+
+def iter_objects(dstore: str):
+    """Iterate over all regular files in the store (os.DirEntry)
+    """
+    for entry in _scan_layout(dstore):
+        if entry.is_file(follow_symlinks=False):
+            yield entry
+
+def iter_gcroots(dstore: str):
+    """Iterate over all gc root directories (os.DirEntry)
+    """
+    gcroots = os.path.join(dstore, "gcroots")
+    if not os.path.isdir(gcroots):
+        return
+
+    for entry in _scan_layout(gcroots):
+        if entry.is_dir(follow_symlinks=False):
+            yield entry
+
+def _move_gcroot(old_root: str, new_root: str, new_object: str) -> None:
+    """Move a gc root directory and re-point its tracked links to new_object
+    """
+    os.makedirs(new_root, exist_ok=True)
+
+    for link in os.scandir(old_root):
+        if not link.is_symlink():
+            continue
+
+        link_path = os.readlink(link.path)
+        tracked = os.path.normpath(os.path.join(old_root, link_path))
+
+        try:
+            target = os.readlink(tracked)
+        except OSError:
+            # dead link, leave it to the garbage collection
+            target = None
+
+        if target != None and os.path.basename(target) == os.path.basename(new_object):
+            if os.path.isabs(target):
+                replace_symlink(os.path.realpath(new_object), tracked)
+            else:
+                replace_symlink(os.path.relpath(new_object, os.path.dirname(tracked)), tracked)
+
+        if not os.path.isabs(link_path):
+            link_path = os.path.relpath(tracked, new_root)
+
+        replace_symlink(link_path, os.path.join(new_root, link.name))
+        os.remove(link.path)
+
+    os.rmdir(old_root)
+
+def _remove_empty_shards(path: str) -> None:
+    shard = os.path.dirname(path)
+    for _ in range(2):
+        if len(os.path.basename(shard)) != 2:
+            return
+        try:
+            os.rmdir(shard)
+        except OSError:
+            return
+        shard = os.path.dirname(shard)
+
+def migrate_store(dstore: str, format: int) -> int:
+    """Convert a store to another layout
+
+    Every file is linked into its new location, before its tracked links
+    are re-pointed and the old location is removed. The store stays
+    usable during the migration. Files are looked up in all other layouts,
+    so that running it again completes an interrupted migration.
+
+        return: number of files moved
+    """
+    set_store_format(dstore, format)
+    old_formats = [ f for f in LAYOUTS.values() if f != format ]
+
+    hashes = { object_hash(file.name) for file in iter_objects(dstore) } - { None }
+    hashes.update(root.name for root in iter_gcroots(dstore))
+
+    moved = 0
+    for hash in hashes:
+        new = _layout_path(dstore, hash, format)
+
+        # the file and its alternative representations
+        old_files = []
+        for name in [ hash ] + [ hash + suffix for suffix in REPRESENTATIONS ]:
+            new_file = _layout_path(dstore, name, format)
+
+            for old in [ _layout_path(dstore, name, f) for f in old_formats ]:
+                if not os.path.lexists(old):
+                    continue
+
+                # the new file may exist already from an interrupted migration
+                if not os.path.exists(new_file):
+                    os.makedirs(os.path.dirname(new_file), exist_ok=True)
+                    try:
+                        os.link(old, new_file)
+                    except FileExistsError:
+                        pass
+                    except OSError:
+                        os.rename(old, new_file)
+                    moved = moved + 1
+                old_files.append(old)
+
+        new_root = _layout_path(os.path.join(dstore, "gcroots"), hash, format)
+        old_roots = [ _layout_path(os.path.join(dstore, "gcroots"), hash, f) for f in old_formats ]
+        for old_root in old_roots:
+            if os.path.isdir(old_root):
+                _move_gcroot(old_root, new_root, new)
+
+        for old in old_files:
+            if os.path.lexists(old):
+                os.remove(old)
+            _remove_empty_shards(old)
+
+        for old_root in old_roots:
+            _remove_empty_shards(old_root)
+
+    return moved
+
 def hash_exists(sha256: str, dstore: str) -> bool:
-    storePath = os.path.join(dstore, sha256)
+    storePath = object_path(sha256, dstore)
 
     if not os.path.exists(storePath):
+        # file may only be stored in another representation
+        for suffix in REPRESENTATIONS:
+            if os.path.exists(object_path(sha256 + suffix, dstore)):
+                return True
+
         return False
 
     return True
@@ -33,25 +308,48 @@ def is_valid_name(hashed_name: str) -> bool:
 
     return False
 
+def object_hash(name: str) -> str:
+    """Hash of a store file or one of its representations, None for other files
+    """
+    if is_valid_name(name):
+        return name
+
+    for suffix in REPRESENTATIONS:
+        if name.endswith(suffix) and is_valid_name(name[:-len(suffix)]):
+            return name[:-len(suffix)]
+
+    return None
+
+def replace_symlink(target: str, path: str) -> None:
+    """Create or atomically replace the symlink path
+
+    Existing files, that are not symlinks, are never replaced.
+    """
+    if os.path.lexists(path) and not os.path.islink(path):
+        raise FileExistsError(errno.EEXIST, os.strerror(errno.EEXIST), path)
+
+    tmp = "{}.tmp-{}-{}".format(path, os.getpid(), threading.get_ident())
+    os.symlink(target, tmp)
+    os.replace(tmp, path)
+
 def link_to_store(path: str, hash: str, dstore: str, relative: bool = True, gcroot: bool = False) -> None:
     """Create a tracked link to data store
-    """
 
-    store_path = os.path.join(dstore, hash)
+    A chunked or compressed file is restored first, links always point to plain files.
+    """
 
-    if os.path.islink(path):
-        os.remove(path)
+    store_path = materialize(hash, dstore)
 
     if relative:
         store_path = os.path.relpath(store_path, os.path.dirname(path))
     else:
         store_path = os.path.realpath(store_path)
 
-    os.symlink(store_path, path)
+    replace_symlink(store_path, path)
 
     # hash/link path hash -> link path
     if gcroot:
-        gc_path = os.path.join(dstore, "gcroots", hash)
+        gc_path = gcroot_path(hash, dstore)
         try:
             os.makedirs(gc_path)
         except FileExistsError:
@@ -66,71 +364,213 @@ def link_to_store(path: str, hash: str, dstore: str, relative: bool = True, gcro
         else:
             link_path = os.path.realpath(path)
 
-        try:
-            os.symlink(link_path, link_name)
-        except FileExistsError:
-            os.remove(link_name)
-            os.symlink(link_path, link_name)
+        replace_symlink(link_path, link_name)
+
+
+def _scan_roots(dstore: str):
+    """Iterate over all gc root links
+
+    A gc root link is alive if the link it points to still points to the hash.
+    Links are only read, not resolved.
+
+        yields: hash, tracked link (None if the gc root link is dead), gc root link
+    """
+    for root in iter_gcroots(dstore):
+        for link in os.scandir(root.path):
+            if not link.is_symlink():
+                continue
+
+            try:
+                # gc root -> tracked link -> store file
+                tracked = os.path.join(root.path, os.readlink(link.path))
+                target = os.readlink(tracked)
+            except OSError:
+                # tracked link has been removed or replaced by a file
+                yield root.name, None, link.path
+                continue
+
+            if os.path.basename(target) == root.name:
+                yield root.name, tracked, link.path
+            else:
+                # tracked link points to a different file now
+                yield root.name, None, link.path
+
+def find_live_roots(dstore: str) -> tuple[set[str], list[str]]:
+    """Mark phase of the garbage collection
+
+        return: set of reachable hashes, list of dead gc root links
+    """
+    reachable = set()
+    dead_links = []
+
+    for hash, tracked, link in _scan_roots(dstore):
+        if tracked == None:
+            dead_links.append(link)
+        else:
+            reachable.add(hash)
+
+    return reachable, dead_links
 
+def find_plain_roots(dstore: str) -> set[str]:
+    """Hashes, which are linked from outside of an inputs directory
 
-def clean_garbage(dstore: str) -> int:
+    These files have to stay plain, so that the links stay readable.
+    Links in inputs/ are created again before a job runs
+    (fspx.link_inputs_to_dir), which restores the plain file.
+    """
+    plain = set()
+    for hash, tracked, _ in _scan_roots(dstore):
+        if tracked != None and os.path.basename(os.path.dirname(tracked)) != "inputs":
+            plain.add(hash)
+
+    return plain
+
+def clean_garbage(dstore: str, dry_run: bool = False, max_bytes: int = None) -> tuple[int, int]:
     """Run garbage collection, and delete unlinked and dead files
+
+        dry_run: only report what would be deleted
+        max_bytes: stop after this many bytes have been freed
+
+        return: number of files and bytes removed
     """
+    reachable, dead_links = find_live_roots(dstore)
+
+    if not dry_run:
+        for link in dead_links:
+            os.remove(link)
 
     files_removed = 0
-    # clear gc roots first, weed out dead links
-    for file in os.scandir(os.path.join(dstore, "gcroots")):
-        if file.is_dir():
-            refcount = 0
-            for link in os.scandir(file.path):
-                if link.is_symlink():
-                    # it is a symlink
-                    if os.path.exists(link.path):
-                        # link is alive
-                        if os.path.basename(os.path.realpath(link.path)) == file.name:
-                            # link points back to this hash/file
-                            refcount = refcount + 1
-                        else:
-                            # gc-root link is dead, does not point back to itself
-                            os.remove(link)
-
-                    elif os.path.lexists(link.path):
-                        # dead link, link does not exists anymore
-                        os.remove(link)
-
-            print(file.name + " " + str(refcount))
-            if refcount == 0:
-                # remove root and data file itself
-                os.rmdir(file.path)
-                os.system("chmod u+w {}".format(os.path.join(dstore, file.name)))
-                os.remove(os.path.join(dstore, file.name))
-                files_removed = files_removed + 1
-
-    # clear out files that do not have gc root
-    for file in os.scandir(dstore):
-        if file.is_file():
-            if not os.path.exists(os.path.join(dstore, "gcroots", file.name)):
-                os.system("chmod u+w {}".format(file.path))
-                os.remove(file.path)
-                files_removed = files_removed + 1
-
-    return files_removed
-
-def verify_store(dstore: str) -> bool:
+    bytes_removed = 0
+    removed = set()
+    for file in iter_objects(dstore):
+        if max_bytes != None and bytes_removed >= max_bytes:
+            break
+
+        hash = object_hash(file.name)
+        if hash in reachable:
+            continue
+
+        size = file.stat(follow_symlinks=False).st_size
+        if dry_run:
+            print("Would remove {} ({} bytes)".format(file.name, size))
+        else:
+            os.remove(file.path)
+            _remove_empty_shards(file.path)
+            gc_path = gcroot_path(hash or file.name, dstore)
+            if os.path.isdir(gc_path):
+                shutil.rmtree(gc_path)
+                _remove_empty_shards(gc_path)
+
+        removed.add(file.name)
+        files_removed = files_removed + 1
+        bytes_removed = bytes_removed + size
+
+    # chunks, which are not used by any remaining chunked file
+    chunks_dir = os.path.join(dstore, "chunks")
+    if os.path.isdir(chunks_dir):
+        live_chunks = set()
+        for file in iter_objects(dstore):
+            if file.name.endswith(CHUNKS_SUFFIX) and not file.name in removed:
+                live_chunks.update(c for c, _ in utils.read_json(file.path))
+
+        for chunk in _scan_layout(chunks_dir):
+            if max_bytes != None and bytes_removed >= max_bytes:
+                break
+
+            if chunk.name in live_chunks or not chunk.is_file(follow_symlinks=False):
+                continue
+
+            size = chunk.stat(follow_symlinks=False).st_size
+            if dry_run:
+                print("Would remove chunk {} ({} bytes)".format(chunk.name, size))
+            else:
+                os.remove(chunk.path)
+                _remove_empty_shards(chunk.path)
+
+            files_removed = files_removed + 1
+            bytes_removed = bytes_removed + size
+
+    # gc root directories without live links, whose file is gone
+    if not dry_run:
+        for root in list(iter_gcroots(dstore)):
+            if not root.name in reachable and not hash_exists(root.name, dstore):
+                shutil.rmtree(root.path)
+                _remove_empty_shards(root.path)
+
+    return files_removed, bytes_removed
+
+def read_ledger(dstore: str) -> dict:
+    """Read the verification ledger: hash -> [size, mtime_ns, ctime_ns, verified]
+    """
+    path = os.path.join(meta_dir(dstore), "verified.json")
+    try:
+        return utils.read_json(path)
+    except (OSError, ValueError):
+        return {}
+
+def write_ledger(dstore: str, ledger: dict) -> None:
+    os.makedirs(meta_dir(dstore), exist_ok=True)
+    utils.write_json_atomic(os.path.join(meta_dir(dstore), "verified.json"), ledger)
+
+def verify_store(dstore: str, jobs: int = 1, incremental: bool = False, sample: float = 0.0, max_age: float = None) -> bool:
     """Verify all files in store
+
+    Files are hashed by a pool of jobs threads, largest files first.
+    In incremental mode only files that are new or have changed since their last
+    successful verification are hashed, plus a random fraction (sample) of the others
+    and those that have not been verified for max_age seconds.
     """
     valid = True
 
-    for file in os.scandir(dstore):
-        if file.is_file():
-            if is_valid_name(file.name):
-                hash = hash_file(os.path.join(dstore, file.name))
-                if hash != file.name:
-                    print("Invalid file found: {} has hash {}".format(file.name, hash))
-                    valid = False
-            else:
-                print("Invalid filename {}".format(file.name))
+    ledger = read_ledger(dstore) if incremental else {}
+    now = time.time()
+
+    files = []
+    skipped = 0
+    for file in iter_objects(dstore):
+        if object_hash(file.name) != None:
+            st = file.stat()
+            key = [st.st_size, st.st_mtime_ns, st.st_ctime_ns]
+
+            entry = ledger.get(file.name)
+            if entry != None and entry[:3] == key:
+                if random.random() >= sample and (max_age == None or now - entry[3] < max_age):
+                    skipped = skipped + 1
+                    continue
+
+            files.append((st.st_size, file.name, key, file.path))
+        else:
+            print("Invalid filename {}".format(file.name))
+            valid = False
+
+    files.sort(reverse=True)
+
+    start = time.monotonic()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = { pool.submit(hash_object, path, dstore): (name, key) for _, name, key, path in files }
+
+        for future in concurrent.futures.as_completed(futures):
+            name, key = futures[future]
+            hash = future.result()
+            if hash != object_hash(name):
+                print("Invalid file found: {} has hash {}".format(name, hash))
+                ledger.pop(name, None)
                 valid = False
+            else:
+                ledger[name] = key + [now]
+
+    elapsed = time.monotonic() - start
+    size = sum(f[0] for f in files)
+    print("Verified {} files ({:.2f} GiB) in {:.1f} s ({:.1f} MiB/s)".format(
+        len(files), size / (1 << 30), elapsed, size / (1 << 20) / max(elapsed, 1e-9)))
+
+    if incremental:
+        print("Skipped {} files verified earlier".format(skipped))
+
+        # forget files, which have been removed from the store
+        ledger = { name: entry for name, entry in ledger.items()
+                   if os.path.exists(object_path(name, dstore)) }
+        write_ledger(dstore, ledger)
 
     return valid
 
@@ -150,39 +590,257 @@ def hash_from_store_path(path: str, dstore: str) -> str:
 
     return os.path.basename(path)
 
-def copy_to_store(path: str, dstore: str) -> str:
+def _reflink(fsrc, fdst) -> bool:
+    """Try to clone the file extents (btrfs, xfs)
+    """
+    if fcntl == None:
+        return False
+
+    try:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+    except OSError:
+        return False
+
+    return True
+
+def _copy_range(fsrc, fdst, copy) -> bool:
+    """Copy a whole file with os.copy_file_range or os.sendfile
+    """
+    try:
+        while copy(fsrc.fileno(), fdst.fileno(), BLOCK_SIZE << 4):
+            pass
+    except OSError as err:
+        if err.errno not in COPY_FALLBACK_ERRNOS:
+            raise
+
+        # start over with the next method
+        fsrc.seek(0)
+        fdst.seek(0)
+        fdst.truncate()
+        return False
+
+    return True
+
+def _hardlink(src: str, dst: str) -> bool:
+    """Try to hardlink src to dst
+    """
+    try:
+        os.link(src, dst)
+    except OSError as err:
+        if err.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+        return False
+
+    return True
+
+def copy_file(src: str, dst: str) -> None:
+    """Copy a file with the fastest method available
+
+    Tries a reflink, copy_file_range and sendfile, in this order,
+    and falls back to a buffered copy.
+    """
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        _count('copied', os.fstat(fsrc.fileno()).st_size)
+
+        if _reflink(fsrc, fdst):
+            return
+
+        if hasattr(os, "copy_file_range"):
+            if _copy_range(fsrc, fdst, os.copy_file_range):
+                return
+
+        if hasattr(os, "sendfile"):
+            if _copy_range(fsrc, fdst, lambda i, o, n: os.sendfile(o, i, None, n)):
+                return
+
+        shutil.copyfileobj(fsrc, fdst, BLOCK_SIZE)
+
+def make_read_only(path: str) -> None:
+    """Remove all write permissions (chmod -w)
+    """
+    mode = os.stat(path).st_mode
+    os.chmod(path, mode & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+
+def tmp_path(dstore: str) -> str:
+    """Unique path for a temporary file on the same file system as the store
+    """
+    tmp_dir = os.path.join(meta_dir(dstore), "tmp")
+    os.makedirs(tmp_dir, exist_ok=True)
+
+    return os.path.join(tmp_dir, "{}-{}-{}".format(os.getpid(), threading.get_ident(), time.monotonic_ns()))
+
+def add_to_store(tmp: str, hash: str, dstore: str) -> None:
+    """Move a temporary file into its place in the store
+    """
+    make_read_only(tmp)
+
+    path = object_path(hash, dstore)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    os.replace(tmp, path)
+
+def copy_and_hash(src: str, dst: str) -> str:
+    """Copy a file and calculate its sha256 in a single pass
+    """
+    sha256 = hashlib.sha256()
+    buf = bytearray(BLOCK_SIZE)
+    view = memoryview(buf)
+
+    with open(src, "rb", buffering=0) as fsrc, open(dst, "wb", buffering=0) as fdst:
+        while True:
+            n = fsrc.readinto(buf)
+            if not n:
+                break
+            sha256.update(view[:n])
+            fdst.write(view[:n])
+            _count('hashed', n)
+            _count('copied', n)
+
+    return sha256.hexdigest()
+
+def copy_to_store(path: str, dstore: str, cache=None, hardlink: bool = False, chunk: bool = True) -> str:
     """Copy file into store
+
+    Files with an unknown hash are read only once: they are hashed while
+    being copied to a temporary file, which is dropped if the store
+    already contains the file.
+
+        cache: optional hash cache, consulted instead of re-hashing the file
+        hardlink: link the file into the store if it is on the same file system.
+                  Note that the file itself becomes read-only.
+        chunk: store large files as chunks, if chunking is enabled for dstore
     """
-    sha256 = hash_file(path)
+    threshold = chunk_threshold(dstore)
+    if chunk and threshold != None and os.path.getsize(path) >= threshold:
+        return _chunk_to_store(path, dstore, cache)
+
     name = os.path.basename(path)
-    storePath = os.path.join(dstore, sha256)
+    tmp = tmp_path(dstore)
+    copied = False
+
+    def hash_and_copy(p: str) -> str:
+        nonlocal copied
+
+        if hardlink and _hardlink(p, tmp):
+            copied = True
+            return hash_file(tmp)
+
+        copied = True
+        return copy_and_hash(p, tmp)
+
+    try:
+        if cache != None:
+            sha256 = cache.hash_file(path, hash_and_copy)
+        else:
+            sha256 = hash_and_copy(path)
+
+        if hash_exists(sha256, dstore):
+            if copied:
+                os.remove(tmp)
+            return sha256
 
-    if not os.path.exists(storePath):
         print("Importing file {} into {} ({})".format(name, dstore, sha256))
-        os.system("cp {} {}".format(path, storePath))
-        os.system("chmod -w {}".format(storePath))
+        if not copied:
+            if not (hardlink and _hardlink(path, tmp)):
+                copy_file(path, tmp)
+
+        add_to_store(tmp, sha256, dstore)
+    except BaseException:
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+        raise
 
     return sha256
 
+def copy_object(hash: str, dstore: str, target: str, chunk: bool = True) -> None:
+    """Copy a file from one store into another store
+
+    The file is not re-hashed, the source store is trusted.
+
+        chunk: store large files as chunks, if chunking is enabled for target.
+               Files that are linked afterwards are kept plain anyway.
+    """
+    if hash_exists(hash, target):
+        return
+
+    tmp = tmp_path(target)
+    try:
+        if os.path.exists(object_path(hash, dstore)):
+            copy_file(object_path(hash, dstore), tmp)
+        elif _reassemble(representation_path(hash, dstore), dstore, tmp) != hash:
+            raise Exception("File {} in {} is corrupted".format(hash, dstore))
+
+        threshold = chunk_threshold(target)
+        if chunk and threshold != None and os.path.getsize(tmp) >= threshold:
+            with open(tmp, "rb") as f:
+                _, chunks = _store_chunks(f, target)
+            _add_chunk_list(hash, chunks, target)
+            os.remove(tmp)
+        else:
+            add_to_store(tmp, hash, target)
+    except BaseException:
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+        raise
+
 def import_data(data, dstore: str) -> str:
     """Write data directly into store
     """
     hash = hash_data(data)
 
     if not hash_exists(hash, dstore):
-        storePath = os.path.join(dstore, hash)
         print("Importing {} into {}".format(hash, dstore))
 
-        with open(storePath, "wb") as f:
+        tmp = tmp_path(dstore)
+        with open(tmp, "wb") as f:
             f.write(data)
+        _count('copied', len(data))
 
-        os.system("chmod -w {}".format(storePath))
+        add_to_store(tmp, hash, dstore)
 
     return hash
 
-def import_paths(paths: list[str], dstore: str, prefix: str="") -> dict[str, str]:
+def import_stream(f, dstore: str) -> str:
+    """Write a binary stream into store, hashing it on the fly
+
+    Only one buffer of the stream is held in memory.
+    """
+    sha256 = hashlib.sha256()
+    buf = bytearray(BLOCK_SIZE)
+    view = memoryview(buf)
+
+    tmp = tmp_path(dstore)
+    try:
+        with open(tmp, "wb", buffering=0) as fdst:
+            while True:
+                n = f.readinto(buf)
+                if not n:
+                    break
+                sha256.update(view[:n])
+                fdst.write(view[:n])
+                _count('hashed', n)
+                _count('copied', n)
+
+        hash = sha256.hexdigest()
+        if hash_exists(hash, dstore):
+            os.remove(tmp)
+        else:
+            print("Importing {} into {}".format(hash, dstore))
+            add_to_store(tmp, hash, dstore)
+    except BaseException:
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+        raise
+
+    return hash
+
+def import_paths(paths: list[str], dstore: str, prefix: str="", cache=None, hardlink: bool = False) -> dict[str, str]:
     """Copy a list of files into the dstore.
 
+        cache: optional hash cache passed on to copy_to_store
+        hardlink: passed on to copy_to_store
+
+    Imported files are linked into the project, they are not chunked.
+
         return: list of sha256 hashes
     """
 
@@ -208,13 +866,386 @@ def import_paths(paths: list[str], dstore: str, prefix: str="") -> dict[str, str
         try:
             idx = p.index(dstore)
         except ValueError:
-            hash = copy_to_store(p, dstore)
+            hash = copy_to_store(p, dstore, cache, hardlink, chunk=False)
         else:
             if idx > 0:
-                hash = copy_to_store(p, dstore)
+                hash = copy_to_store(p, dstore, cache, hardlink, chunk=False)
             else:
                 hash = os.path.basename(p)
 
         pathkv[name] = hash
 
     return pathkv
+
+#
+# Chunked files
+#
+# <dstore>/<hash>.chunks        list of [chunk hash, size], replaces <dstore>/<hash>
+# <dstore>/chunks/ab/cd/<chunk> chunk data, shared between files
+#
+# Files are split by content defined chunking, so versions of a large
+# file share most of their chunks. The file hash stays the sha256 of the
+# whole file. Files linked from a project, except from inputs/, stay plain
+# files, so that the links stay readable. A chunked file is restored when it
+# is linked again (materialize), for inputs/ before every run of the job. Files copied into a store with <dstore>/meta/chunking (minimum size)
+# are stored as chunks.
+#
+
+CHUNKS_SUFFIX = ".chunks"
+
+# Cache of chunking thresholds, dstore -> minimum file size or None
+_chunk_thresholds = {}
+
+def chunk_threshold(dstore: str) -> int:
+    """Minimum size of files stored as chunks, None if chunking is disabled
+    """
+    if dstore not in _chunk_thresholds:
+        try:
+            with open(os.path.join(meta_dir(dstore), "chunking")) as f:
+                _chunk_thresholds[dstore] = int(f.read())
+        except FileNotFoundError:
+            _chunk_thresholds[dstore] = None
+
+    return _chunk_thresholds[dstore]
+
+def set_chunk_threshold(dstore: str, min_size: int) -> None:
+    os.makedirs(meta_dir(dstore), exist_ok=True)
+    with open(os.path.join(meta_dir(dstore), "chunking"), "w") as f:
+        f.write("{}\n".format(min_size))
+
+    _chunk_thresholds[dstore] = min_size
+
+def chunk_path(chunk: str, dstore: str) -> str:
+    return _layout_path(os.path.join(dstore, "chunks"), chunk, FORMAT_SHARDED)
+
+def _store_chunks(f, dstore: str) -> tuple[str, list]:
+    """Split a stream into chunks and add the missing ones to the store
+
+        return: sha256 of the stream, list of [chunk hash, size]
+    """
+    sha256 = hashlib.sha256()
+    chunks = []
+
+    for data in chunking.iter_chunks(f):
+        sha256.update(data)
+        _count('hashed', len(data))
+
+        chunk = hashlib.sha256(data).hexdigest()
+        chunks.append([chunk, len(data)])
+
+        path = chunk_path(chunk, dstore)
+        if not os.path.exists(path):
+            tmp = tmp_path(dstore)
+            with open(tmp, "wb") as fc:
+                fc.write(data)
+            _count('copied', len(data))
+
+            make_read_only(tmp)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp, path)
+
+    return sha256.hexdigest(), chunks
+
+def _add_chunk_list(hash: str, chunks: list, dstore: str) -> None:
+    tmp = tmp_path(dstore)
+    with open(tmp, "w") as f:
+        json.dump(chunks, f)
+
+    add_to_store(tmp, hash + CHUNKS_SUFFIX, dstore)
+
+def _chunk_to_store(path: str, dstore: str, cache=None) -> str:
+    """Import a file as chunks, see copy_to_store
+    """
+    chunks = None
+
+    def hash_and_chunk(p: str) -> str:
+        nonlocal chunks
+
+        with open(p, "rb") as f:
+            sha256, chunks = _store_chunks(f, dstore)
+
+        return sha256
+
+    if cache != None:
+        sha256 = cache.hash_file(path, hash_and_chunk)
+    else:
+        sha256 = hash_and_chunk(path)
+
+    if hash_exists(sha256, dstore):
+        return sha256
+
+    print("Importing file {} into {} as chunks ({})".format(os.path.basename(path), dstore, sha256))
+    if chunks == None and hash_and_chunk(path) != sha256:
+        raise Exception("{} has changed during import".format(path))
+
+    _add_chunk_list(sha256, chunks, dstore)
+
+    return sha256
+
+def _restore_linked(dstore: str) -> set[str]:
+    """Restore files, which have to stay plain, but are stored as chunks or compressed
+
+        return: hashes of all files, which have to stay plain (see find_plain_roots)
+    """
+    plain = find_plain_roots(dstore)
+    for hash in plain:
+        if representation_path(hash, dstore) != None:
+            materialize(hash, dstore)
+
+    return plain
+
+def chunk_store(dstore: str, min_size: int) -> tuple[int, int]:
+    """Enable chunking and replace plain files of at least min_size by their chunks
+
+    Linked files are kept plain, except those only linked from inputs/ (see find_plain_roots).
+
+        return: number of files converted, bytes of the plain files removed
+    """
+    set_chunk_threshold(dstore, min_size)
+    plain = _restore_linked(dstore)
+
+    files = 0
+    size = 0
+    for file in list(iter_objects(dstore)):
+        if not is_valid_name(file.name) or file.name in plain or file.stat().st_size < min_size:
+            continue
+
+        with open(file.path, "rb") as f:
+            sha256, chunks = _store_chunks(f, dstore)
+
+        if sha256 != file.name:
+            print("Invalid file found: {} has hash {}, not chunked".format(file.name, sha256))
+            continue
+
+        if not os.path.exists(object_path(file.name + CHUNKS_SUFFIX, dstore)):
+            _add_chunk_list(file.name, chunks, dstore)
+
+        size = size + file.stat().st_size
+        files = files + 1
+        os.remove(file.path)
+
+    return files, size
+
+#
+# Compressed files
+#
+# <dstore>/<hash>.xz, <dstore>/<hash>.gz replace <dstore>/<hash>
+#
+# Files, which have not been used for some time, are compressed by
+# store-compress, if a sample shows that they compress well. lzma gives
+# the best ratio, gzip is used for large files, where lzma is too slow.
+# Linked files are not compressed, except those only linked from inputs/.
+# The plain file is restored when it is linked again (materialize).
+#
+
+COMPRESSORS = { ".xz": lzma.open, ".gz": gzip.open }
+
+# Files larger than this are compressed with gzip
+LZMA_MAX_SIZE = 64 << 20
+
+# Size of the sample and the compression ratio it needs to reach
+SAMPLE_SIZE = 1 << 18
+SAMPLE_RATIO = 0.8
+
+def is_compressible(path: str) -> bool:
+    """Estimate the compressibility of a file by a fast compression of its beginning
+    """
+    with open(path, "rb") as f:
+        sample = f.read(SAMPLE_SIZE)
+
+    if len(sample) == 0:
+        return False
+
+    return len(zlib.compress(sample, 1)) < SAMPLE_RATIO * len(sample)
+
+def compress_object(hash: str, dstore: str) -> int:
+    """Replace a plain store file by a compressed version
+
+        return: number of bytes saved
+    """
+    path = object_path(hash, dstore)
+    size = os.path.getsize(path)
+
+    if representation_path(hash, dstore) == None:
+        suffix = ".xz" if size <= LZMA_MAX_SIZE else ".gz"
+
+        tmp = tmp_path(dstore)
+        try:
+            sha256 = hashlib.sha256()
+            buf = bytearray(BLOCK_SIZE)
+            view = memoryview(buf)
+
+            with open(path, "rb", buffering=0) as fsrc, COMPRESSORS[suffix](tmp, "wb") as fdst:
+                while True:
+                    n = fsrc.readinto(buf)
+                    if not n:
+                        break
+                    sha256.update(view[:n])
+                    fdst.write(view[:n])
+                    _count('hashed', n)
+
+            if sha256.hexdigest() != hash:
+                raise Exception("Invalid file found: {} has hash {}".format(hash, sha256.hexdigest()))
+
+            if os.path.getsize(tmp) >= SAMPLE_RATIO * size:
+                # sample was not representative
+                os.remove(tmp)
+                return 0
+
+            add_to_store(tmp, hash + suffix, dstore)
+        except BaseException:
+            if os.path.lexists(tmp):
+                os.remove(tmp)
+            raise
+
+    saved = size - os.path.getsize(representation_path(hash, dstore))
+    os.remove(path)
+
+    return saved
+
+def compress_store(dstore: str, min_size: int = 4096, min_age: float = None) -> tuple[int, int]:
+    """Compress plain files of at least min_size, which compress well
+
+        min_age: only compress files not accessed or modified for this many seconds
+
+    Linked files are kept plain, except those only linked from inputs/ (see find_plain_roots).
+
+        return: number of files compressed, bytes saved
+    """
+    now = time.time()
+    plain = _restore_linked(dstore)
+
+    files = 0
+    saved = 0
+    for file in list(iter_objects(dstore)):
+        if not is_valid_name(file.name) or file.name in plain:
+            continue
+
+        st = file.stat()
+        if st.st_size < min_size:
+            continue
+
+        if min_age != None and now - max(st.st_atime, st.st_mtime) < min_age:
+            continue
+
+        if representation_path(file.name, dstore) == None and not is_compressible(file.path):
+            continue
+
+        saved = saved + compress_object(file.name, dstore)
+        files = files + 1
+
+    return files, saved
+
+#
+# Representations
+#
+
+# Representations of store files other than the plain file, by suffix
+REPRESENTATIONS = [ CHUNKS_SUFFIX ] + list(COMPRESSORS)
+
+def representation_path(hash: str, dstore: str) -> str:
+    """Path of a stored representation of a file, None if there is none
+    """
+    for suffix in REPRESENTATIONS:
+        path = object_path(hash + suffix, dstore)
+        if os.path.exists(path):
+            return path
+
+    return None
+
+def _read_representation(path: str, dstore: str):
+    """Iterate over the content of a file stored in any representation
+    """
+    name = os.path.basename(path)
+
+    if name.endswith(CHUNKS_SUFFIX):
+        for chunk, _ in utils.read_json(path):
+            with open(chunk_path(chunk, dstore), "rb") as f:
+                yield f.read()
+        return
+
+    suffix = os.path.splitext(name)[1]
+    with COMPRESSORS.get(suffix, open)(path, "rb") as f:
+        while True:
+            data = f.read(BLOCK_SIZE)
+            if not data:
+                return
+            yield data
+
+def _reassemble(path: str, dstore: str, dst: str = None) -> str:
+    """Restore a file from its representation into dst, or only hash it
+
+        return: sha256 of the restored file
+    """
+    sha256 = hashlib.sha256()
+    fdst = open(dst, "wb") if dst != None else None
+
+    try:
+        for data in _read_representation(path, dstore):
+            sha256.update(data)
+            _count('hashed', len(data))
+            if fdst != None:
+                fdst.write(data)
+                _count('copied', len(data))
+    finally:
+        if fdst != None:
+            fdst.close()
+
+    return sha256.hexdigest()
+
+def hash_object(path: str, dstore: str) -> str:
+    """Calculate the sha256 of the file stored in path in any representation
+    """
+    if is_valid_name(path):
+        return hash_file(path)
+
+    return _reassemble(path, dstore)
+
+def copy_and_hash_object(hash: str, dstore: str, dst: str) -> str:
+    """Copy a store file in any representation to dst and calculate its sha256
+    """
+    path = object_path(hash, dstore)
+    if os.path.exists(path):
+        return copy_and_hash(path, dst)
+
+    rep = representation_path(hash, dstore)
+    if rep == None:
+        raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+
+    return _reassemble(rep, dstore, dst)
+
+def materialize(hash: str, dstore: str) -> str:
+    """Restore a store file as plain file and remove its other representation
+
+    Chunks, which are not used anymore, are removed by the garbage collection.
+
+        return: path of the file
+    """
+    path = object_path(hash, dstore)
+    rep = representation_path(hash, dstore)
+    if rep == None:
+        return path
+
+    if not os.path.exists(path):
+        tmp = tmp_path(dstore)
+        try:
+            if _reassemble(rep, dstore, tmp) != hash:
+                raise Exception("File {} in {} is corrupted".format(os.path.basename(rep), dstore))
+            add_to_store(tmp, hash, dstore)
+        except FileNotFoundError:
+            # restored concurrently
+            if os.path.lexists(tmp):
+                os.remove(tmp)
+            if not os.path.exists(object_path(hash, dstore)):
+                raise
+        except BaseException:
+            if os.path.lexists(tmp):
+                os.remove(tmp)
+            raise
+
+    try:
+        os.remove(rep)
+    except FileNotFoundError:
+        None
+
+    return object_path(hash, dstore)
@@ -0,0 +1,151 @@
+# SPDX-FileCopyrightText: 2022 Markus Kowalewski
+#
+# SPDX-License-Identifier: GPL-3.0-only
+
+'''Content defined chunking
+
+Chunk boundaries are placed where a rolling hash over the last bytes
+matches a mask. Inserting or removing data in a file only changes the
+chunks around the modification, all other chunks stay the same.
+
+Minimum size skipping and normalized chunking follow FastCDC (Xia et al.,
+USENIX ATC 2016). The rolling hash is a windowed sum of random values per
+byte instead of the gear hash: it can be computed for a whole buffer with
+a cumulative sum, which numpy does at several hundred MB/s. Without numpy
+a pure Python loop finds the same boundaries, but is about 20 times slower.
+'''
+
+import hashlib
+
+# imported on first use, see _finder
+numpy = None
+
+
+# Chunk sizes, large chunks keep the per file chunk lists short
+MIN_SIZE = 256 << 10
+AVG_SIZE = 1 << 20
+MAX_SIZE = 4 << 20
+
+# Number of bytes the rolling hash depends on
+WINDOW = 64
+
+# Bytes hashed per numpy call, boundaries are usually found early in a region
+BLOCK = 256 << 10
+
+# Random 32 bit value for every byte, fixed to make boundaries reproducible
+TABLE = [ int.from_bytes(hashlib.sha256(bytes([i])).digest()[:4], "little") for i in range(256) ]
+
+_M32 = 0xffffffff
+
+def _masks(avg_size: int) -> tuple[int, int]:
+    """Masks on the high bits for normalized chunking
+
+    Before the average size is reached a harder mask (more bits) is used,
+    after it an easier one. This narrows the distribution of chunk sizes.
+    """
+    bits = avg_size.bit_length() - 1
+    return _M32 ^ (_M32 >> (bits + 1)), _M32 ^ (_M32 >> (bits - 1))
+
+def _find_python(data, start: int, end: int, mask: int) -> int:
+    """Index of the first byte in [start, end) at which the hash matches mask or -1
+    """
+    table = TABLE
+    lo = max(0, start - WINDOW + 1)
+
+    h = 0
+    for i in range(lo, start):
+        h = h + table[data[i]]
+
+    for i in range(start, end):
+        h = h + table[data[i]]
+        if i - WINDOW >= lo:
+            h = h - table[data[i - WINDOW]]
+        h = h & _M32
+        if not h & mask:
+            return i
+
+    return -1
+
+def _find_numpy(data, start: int, end: int, mask: int) -> int:
+    buf = numpy.frombuffer(data, dtype=numpy.uint8)
+    mask = numpy.uint32(mask)
+
+    for s in range(start, end, BLOCK):
+        e = min(end, s + BLOCK)
+        lo = max(0, s - WINDOW + 1)
+
+        # window sums from a cumulative sum, WINDOW zeros in front for windows reaching before lo
+        csum = numpy.zeros(e - lo + WINDOW, dtype=numpy.uint32)
+        numpy.cumsum(_TABLE.take(buf[lo:e]), dtype=numpy.uint32, out=csum[WINDOW:])
+        h = csum[WINDOW:] - csum[:-WINDOW]
+
+        hits = numpy.flatnonzero((h[s - lo:] & mask) == 0)
+        if len(hits):
+            return s + int(hits[0])
+
+    return -1
+
+_find = None
+
+def _finder():
+    """Select the boundary search on first use
+
+    numpy is only imported here, importing it takes longer than checking a
+    whole project, which never needs it.
+    """
+    global numpy, _TABLE, _find
+
+    if _find == None:
+        try:
+            import numpy
+            _TABLE = numpy.array(TABLE, dtype=numpy.uint32)
+            _find = _find_numpy
+        except ImportError:
+            _find = _find_python
+
+    return _find
+
+def have_numpy() -> bool:
+    """True if numpy is available to find chunk boundaries
+    """
+    return _finder() == _find_numpy
+
+def cut_point(data, min_size: int = MIN_SIZE, avg_size: int = AVG_SIZE, max_size: int = MAX_SIZE) -> int:
+    """Length of the first chunk in data
+    """
+    n = len(data)
+    if n <= min_size:
+        return n
+
+    n = min(n, max_size)
+    normal = min(n, avg_size)
+    hard, easy = _masks(avg_size)
+    find = _finder()
+
+    # bytes before min_size can not be a boundary
+    for start, end, mask in [ (min_size, normal, hard), (normal, n, easy) ]:
+        i = find(data, start, end, mask)
+        if i >= 0:
+            return i + 1
+
+    return n
+
+def iter_chunks(f, min_size: int = MIN_SIZE, avg_size: int = AVG_SIZE, max_size: int = MAX_SIZE):
+    """Split the binary stream f into chunks (bytes)
+    """
+    buf = bytearray()
+    eof = False
+
+    while True:
+        while not eof and len(buf) < max_size:
+            data = f.read(max_size)
+            if not data:
+                eof = True
+            buf += data
+
+        if not buf:
+            return
+
+        n = cut_point(memoryview(buf), min_size, avg_size, max_size)
+        yield bytes(buf[:n])
+        del buf[:n]
@@ -0,0 +1,100 @@
+# SPDX-FileCopyrightText: 2022 Markus Kowalewski
+#
+# SPDX-License-Identifier: GPL-3.0-only
+
+import collections
+
+
+def dependencies(jobsets: dict) -> dict[str, list[str]]:
+    """Map every job to the jobs producing its inputs
+    """
+    producers = {}
+    for name, job in jobsets.items():
+        for output in job['outputs']:
+            producers[output] = name
+
+    deps = {}
+    for name, job in jobsets.items():
+        deps[name] = sorted({ producers[file[1:]] for file in job['inputs']
+                              if file[0] == ":" and file[1:] in producers })
+
+    return deps
+
+class Dag:
+    """Dependency graph of a project
+
+    Built from a flat adjacency list (job -> direct dependencies).
+    The topological order is computed once, dependencies come before
+    their consumers.
+    """
+
+    def __init__(self, deps: dict[str, list[str]]):
+        self.deps = { name: list(d) for name, d in deps.items() }
+        self.consumers = { name: [] for name in deps }
+
+        for name, d in self.deps.items():
+            for dep in d:
+                if not dep in self.consumers:
+                    raise Exception("Job {} depends on unknown job {}".format(name, dep))
+                self.consumers[dep].append(name)
+
+        self.order = self._topological_order()
+
+    @classmethod
+    def from_config(cls, config: dict) -> "Dag":
+        """Use the graph emitted by the build, fall back to the job definitions
+        """
+        if 'graph' in config:
+            return cls(config['graph'])
+
+        return cls(dependencies(config['jobsets']))
+
+    def _topological_order(self) -> list[str]:
+        # Kahn's algorithm, keep the input order for independent jobs
+        indegree = { name: len(d) for name, d in self.deps.items() }
+        ready = collections.deque([ name for name, n in indegree.items() if n == 0 ])
+        order = []
+
+        while ready:
+            name = ready.popleft()
+            order.append(name)
+            for consumer in self.consumers[name]:
+                indegree[consumer] -= 1
+                if indegree[consumer] == 0:
+                    ready.append(consumer)
+
+        if len(order) != len(self.deps):
+            cycle = [ name for name, n in indegree.items() if n > 0 ]
+            raise Exception("Dependency cycle between jobs {}".format(", ".join(cycle)))
+
+        return order
+
+    def _closure(self, names: list[str], edges: dict[str, list[str]]) -> set[str]:
+        closure = set()
+        stack = list(names)
+
+        while stack:
+            name = stack.pop()
+            if not name in edges:
+                raise Exception("Unknown job {}".format(name))
+
+            if not name in closure:
+                closure.add(name)
+                stack.extend(edges[name])
+
+        return closure
+
+    def upstream(self, names: list[str]) -> set[str]:
+        """Jobs and everything they depend on
+        """
+        return self._closure(names, self.deps)
+
+    def downstream(self, names: list[str]) -> set[str]:
+        """Jobs and everything depending on them
+        """
+        return self._closure(names, self.consumers)
+
+    def sorted(self, names) -> list[str]:
+        """Jobs from names in topological order
+        """
+        return [ name for name in self.order if name in names ]
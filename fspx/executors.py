@@ -0,0 +1,268 @@
+# SPDX-FileCopyrightText: 2022 Markus Kowalewski
+#
+# SPDX-License-Identifier: GPL-3.0-only
+
+'''Executors run the jobs scheduled by fspx.run_jobs
+
+A task passed to an executor provides:
+
+    name        job name
+    run()       prepare, run and check the job in the calling thread
+    prepare()   import and link inputs, returns False if the job does not
+                need to run, because the outputs of an interrupted run are adopted
+                or substituted from a binary cache
+    command()   shell command that runs the job in its workdir
+    finish(ret) evaluate the exit code of command() and run the check script
+
+Failures are signalled by exceptions raised from these methods.
+'''
+
+import os
+import abc
+import time
+import shlex
+import subprocess
+import concurrent.futures
+
+
+class Executor(abc.ABC):
+    """Interface of all executors
+
+    submit() hands a task to the executor, wait() blocks until at least one
+    submitted task has finished and returns a list of (task, exception or None).
+    Errors of a task are only reported by wait(), never raised by submit().
+    """
+
+    # Maximum number of tasks submitted at the same time
+    max_jobs = 1
+
+    @abc.abstractmethod
+    def submit(self, task) -> None:
+        """Start a task or queue it
+        """
+
+    @abc.abstractmethod
+    def wait(self) -> list:
+        """Wait for tasks to finish
+        """
+
+    @abc.abstractmethod
+    def running(self) -> int:
+        """Number of tasks submitted, which have not been returned by wait()
+        """
+
+    def close(self) -> None:
+        """Release resources, called when the run ends or is interrupted
+        """
+
+class LocalExecutor(Executor):
+    """Run one task at a time in the calling thread
+    """
+
+    def __init__(self):
+        self.queue = []
+
+    def submit(self, task) -> None:
+        self.queue.append(task)
+
+    def wait(self) -> list:
+        task = self.queue.pop(0)
+        try:
+            task.run()
+        except Exception as err:
+            return [(task, err)]
+
+        return [(task, None)]
+
+    def running(self) -> int:
+        return len(self.queue)
+
+class PoolExecutor(Executor):
+    """Run up to max_jobs tasks concurrently
+
+    Jobs are separate processes anyway, the worker threads only wait for them
+    and do the hashing, which releases the GIL.
+    """
+
+    def __init__(self, max_jobs: int):
+        self.max_jobs = max_jobs
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=max_jobs)
+        self.futures = {}
+
+    def submit(self, task) -> None:
+        self.futures[self.pool.submit(task.run)] = task
+
+    def wait(self) -> list:
+        done, _ = concurrent.futures.wait(self.futures, return_when=concurrent.futures.FIRST_COMPLETED)
+
+        finished = []
+        for future in done:
+            task = self.futures.pop(future)
+            finished.append((task, future.exception()))
+
+        return finished
+
+    def running(self) -> int:
+        return len(self.futures)
+
+    def close(self) -> None:
+        # let running jobs finish
+        self.pool.shutdown(wait=True)
+
+class SlurmExecutor(Executor):
+    """Submit tasks to a Slurm style batch system
+
+    Inputs are prepared locally. All tasks submitted between two calls of wait()
+    are packed into one array job. Every array task writes the exit code of
+    its job into a status file, which is polled together with the queue.
+    The check script runs locally once a job has finished.
+    Array jobs, which are still queued or running, are cancelled by close().
+
+        sbatch, squeue, scancel: commands, can be replaced by stand-ins for testing
+    """
+
+    def __init__(self, max_jobs: int, batch_dir: str, options: str = "",
+                 sbatch: str = "sbatch", squeue: str = "squeue", poll_interval: float = 10,
+                 scancel: str = "scancel"):
+        self.max_jobs = max_jobs
+        self.batch_dir = batch_dir
+        self.options = shlex.split(options)
+        self.sbatch = shlex.split(sbatch)
+        self.squeue = shlex.split(squeue)
+        self.scancel = shlex.split(scancel)
+        self.poll_interval = poll_interval
+
+        self.queued = []
+        # tasks that do not need to run, only checked
+        self.adopted = []
+        # tasks that have failed in prepare(), (task, exception)
+        self.failed = []
+        # array job id -> (script, list of (task, status file))
+        self.arrays = {}
+
+    def submit(self, task) -> None:
+        try:
+            run = task.prepare()
+        except Exception as err:
+            self.failed.append((task, err))
+            return
+
+        if run:
+            self.queued.append(task)
+        else:
+            self.adopted.append(task)
+
+    def _submit_array(self) -> None:
+        os.makedirs(self.batch_dir, exist_ok=True)
+        script = os.path.join(self.batch_dir, "array-{}-{}.sh".format(os.getpid(), time.monotonic_ns()))
+
+        tasks = []
+        with open(script, "w") as f:
+            f.write("#!/bin/sh\n")
+            f.write("case \"$SLURM_ARRAY_TASK_ID\" in\n")
+            for i, task in enumerate(self.queued):
+                status = os.path.abspath("{}.{}.exit".format(script, i))
+                f.write("  {}) {}; echo $? > {}.tmp; mv {}.tmp {} ;;\n".format(
+                    i, task.command(), *[shlex.quote(status)] * 3))
+                tasks.append((task, status))
+            f.write("esac\n")
+
+        cmd = self.sbatch + [ "--parsable", "--array=0-{}".format(len(tasks) - 1) ] + self.options + [ script ]
+        out = subprocess.run(cmd, check=True, stdout=subprocess.PIPE, text=True).stdout
+
+        # --parsable prints jobid[;cluster]
+        job_id = out.strip().split(";")[0]
+        print("Submitted {} as array job {}".format(", ".join(t.name for t, _ in tasks), job_id))
+
+        self.arrays[job_id] = (script, tasks)
+        self.queued = []
+
+    def _in_queue(self, job_id: str) -> bool:
+        out = subprocess.run(self.squeue + [ "-h", "-j", job_id, "-o", "%i" ],
+                             stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True).stdout
+        return out.strip() != ""
+
+    def _finish(self, task, status: str):
+        try:
+            with open(status) as f:
+                ret = int(f.read())
+            os.remove(status)
+        except (OSError, ValueError):
+            # array task vanished without writing its status (cancelled, node failure)
+            ret = -1
+
+        try:
+            task.finish(ret)
+        except Exception as err:
+            return (task, err)
+
+        return (task, None)
+
+    def wait(self) -> list:
+        if self.failed or self.adopted:
+            finished = self.failed
+            self.failed = []
+            for task in self.adopted:
+                try:
+                    task.finish(0)
+                    finished.append((task, None))
+                except Exception as err:
+                    finished.append((task, err))
+
+            self.adopted = []
+            return finished
+
+        if self.queued:
+            try:
+                self._submit_array()
+            except (OSError, subprocess.CalledProcessError) as err:
+                finished = [ (task, err) for task in self.queued ]
+                self.queued = []
+                return finished
+
+        while True:
+            finished = []
+            for job_id in list(self.arrays):
+                script, tasks = self.arrays[job_id]
+
+                done = [ t for t in tasks if os.path.exists(t[1]) ]
+                if len(done) < len(tasks) and not self._in_queue(job_id):
+                    # job has left the queue, remaining tasks have failed
+                    done = list(tasks)
+
+                for t in done:
+                    tasks.remove(t)
+                    finished.append(self._finish(*t))
+
+                if not tasks:
+                    del self.arrays[job_id]
+                    os.remove(script)
+
+            if finished:
+                return finished
+
+            time.sleep(self.poll_interval)
+
+    def running(self) -> int:
+        return len(self.queued) + len(self.adopted) + len(self.failed) \
+            + sum(len(tasks) for _, tasks in self.arrays.values())
+
+    def close(self) -> None:
+        if not self.arrays:
+            return
+
+        job_ids = list(self.arrays)
+        print("Cancelling array jobs {}".format(" ".join(job_ids)))
+        try:
+            subprocess.run(self.scancel + job_ids, check=True)
+        except (OSError, subprocess.CalledProcessError) as err:
+            print("Can not cancel array jobs {}: {}".format(" ".join(job_ids), err))
+
+        for script, tasks in self.arrays.values():
+            for _, status in tasks:
+                for path in [ status, status + ".tmp" ]:
+                    if os.path.lexists(path):
+                        os.remove(path)
+            os.remove(script)
+
+        self.arrays = {}
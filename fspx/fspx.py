@@ -3,13 +3,37 @@
 # SPDX-License-Identifier: GPL-3.0-only
 
 import os
+import time
+import shutil
+import subprocess
+import concurrent.futures
 
-from . import utils
 from . import cas
+from . import hashcache
+from . import dag
+from . import manifest
+from . import stats
+from . import executors
+from . import journal
+from . import substitute
 
 # Default path for project files
 cfgPath = ".fspx/"
 
+class JobFailed(Exception):
+    """Raised when a job script or its check script fails
+    """
+    pass
+
+# Hashes of raw input files, keyed by stat information
+hash_cache = hashcache.HashCache(os.path.join(cfgPath, "hashcache.json"))
+
+# Job manifests, loaded once and written back by manifests.flush()
+manifests = manifest.ManifestStore(cfgPath)
+
+# Write-ahead journal of fspx run, used by run --resume
+run_journal = journal.RunJournal(os.path.join(cfgPath, "journal.jsonl"))
+
 def is_output(name: str) -> bool:
     if name[0] == ":":
         return True
@@ -38,15 +62,14 @@ def import_input_paths(job: dict, name: str, dstore: str) -> dict:
         if not is_output(file):
             # import paths if needed
             if hash == None:
-                hash = cas.import_paths([file], dstore)
+                hash = cas.import_paths([file], dstore, cache=hash_cache)
                 hash = hash[file]
             elif not cas.hash_exists(hash, dstore):
-                hash = cas.import_paths([file], dstore)
+                hash = cas.import_paths([file], dstore, cache=hash_cache)
                 hash = hash[file]
         else:
-            # import to check hash
-            hash = cas.import_paths([to_outpath(file)], dstore)
-            hash = hash[to_outpath(file)]
+            # outputs are already in the store, take the hash from the link
+            hash = cas.hash_from_store_path(to_outpath(file), dstore)
 
         # check manifest
         if not file in m['inputs']:
@@ -84,33 +107,11 @@ def import_output_paths(job, name: str, dstore: str) -> dict[str, str] :
 
 def read_manifest(name: str) -> dict:
 
-    mfile = "{}/{}.manifest".format(cfgPath, name)
-    if os.path.exists(mfile):
-        m = utils.read_json(mfile)
-    else:
-        m = {'inputs':{}, 'function':"", 'outputs':{}}
-
-    return m
+    return manifests.get(name)
 
 def update_manifest(name: str, data) -> None:
 
-    mfile = "{}/{}.manifest".format(cfgPath, name)
-    if os.path.exists(mfile):
-        m = utils.read_json(mfile)
-    else:
-        m = {}
-
-    m = { **m, **data }
-
-    utils.write_json(mfile, m)
-
-def find_all_jobs(jobsets, jobs = []):
-
-    for name, job in jobsets.items():
-        find_all_jobs(job['deps'], jobs = jobs)
-        jobs.append({ 'name' : name, 'job' : job})
-
-    return jobs
+    manifests.update(name, data)
 
 def check_job(name: str, job: dict, dstore: str) -> bool:
     """Check if the current config matches the manifest
@@ -159,31 +160,27 @@ def check_job(name: str, job: dict, dstore: str) -> bool:
 
             hash = cas.hash_from_store_path(to_outpath(file), dstore)
         else:
-            hash = cas.hash_file(file)
+            hash = hash_cache.hash_file(file)
 
         if manifest['inputs'][file] != hash:
             return False
 
     return True
 
-def check_jobset(jobset: dict, dstore: str, recalc = []) -> tuple[list[str], bool]:
-    """Check all jobsets and return invalidated ones
+def check_jobs(graph: dag.Dag, jobsets: dict, dstore: str, jobnames: set[str] = None) -> tuple[list[str], bool]:
+    """Check all jobs, or only those in jobnames, and return invalidated ones
+
+    Every job is checked exactly once, in topological order.
     """
 
-    valid = True
-    for name, job in jobset.items():
-        if name not in recalc:
-            # check children
-            recalc, cvalid = check_jobset(job['deps'], dstore, recalc)
+    order = graph.order if jobnames == None else graph.sorted(jobnames)
 
-            valid = cvalid
-            if not check_job(name, job, dstore):
-                valid = False
-                recalc.append(name)
-        else:
-            valid = False
+    recalc = []
+    for name in order:
+        if not check_job(name, jobsets[name], dstore):
+            recalc.append(name)
 
-    return recalc, valid
+    return recalc, len(recalc) == 0
 
 def link_inputs_to_dir(inputs: dict[str, str], dir: str, dstore: str, gcroots: bool = False) -> None:
     try:
@@ -195,64 +192,206 @@ def link_inputs_to_dir(inputs: dict[str, str], dir: str, dstore: str, gcroots: b
         tmpName = "{}/inputs/{}".format(dir, os.path.basename(to_outpath(inp)))
         cas.link_to_store(tmpName , hash, dstore, gcroot = gcroots)
 
-def validate_jobs(jobset, jobnames: list[str], dstore: str, global_launcher=None) -> bool:
+def validate_job(name: str, job: dict, dstore: str, global_launcher=None) -> list[str]:
+    """Re-run a job in its own workdir and compare the outputs with the manifest
+
+    The workdir is removed if all outputs are reproduced, otherwise
+    it is kept for inspection until the next validation.
+
+        return: outputs, which could not be reproduced
+    """
+    print("Verify job {}".format(name))
+
+    job = dict(job)
+    job['workdir'] = job['workdir'].rstrip('/') + "-validate"
+    workdir = os.path.expandvars(job['workdir'])
+
+    # outputs left from a failed validation must not count as reproduced
+    shutil.rmtree(workdir, ignore_errors=True)
+
+    run_job(name, job, dstore, global_launcher)
+
+    # compare with outputs from manifest
+    outputs_manifest = read_manifest(name)['outputs']
+    mismatches = []
+    for output in job['outputs']:
+        path = os.path.join(workdir, output)
+        if not os.path.exists(path) or outputs_manifest.get(output) != cas.hash_file(path):
+            print("Output {} of job {} can not be reproduced".format(output, name))
+            mismatches.append(output)
+
+    if not mismatches:
+        shutil.rmtree(workdir)
+
+    return mismatches
+
+def validate_jobs(jobset, jobnames: list[str], dstore: str, global_launcher=None, jobs: int = 1) -> bool:
     """Validate jobs
+
+    Up to jobs validations run concurrently. All jobs are validated,
+    failures are reported at the end.
+    """
+    failed = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = { pool.submit(validate_job, name, jobset[name], dstore, global_launcher): name for name in jobnames }
+
+        for future in concurrent.futures.as_completed(futures):
+            name = futures[future]
+            try:
+                mismatches = future.result()
+            except JobFailed as err:
+                print(err)
+                failed[name] = str(err)
+                continue
+            except Exception as err:
+                print("Validation of job {} failed: {}".format(name, err))
+                failed[name] = "{}: {}".format(type(err).__name__, err)
+                continue
+
+            if mismatches:
+                failed[name] = "outputs not reproduced: {}".format(", ".join(mismatches))
+
+    print("Validated {} jobs, {} failed".format(len(jobnames), len(failed)))
+    for name in sorted(failed):
+        print("  {}: {}".format(name, failed[name]))
+
+    return len(failed) == 0
+
+def job_script(job: dict) -> str:
+    """Script to start a job
+
+    Prefer the script using the environment realized by fspx build,
+    which avoids evaluating nix-shell for every job.
+    """
+    if 'directScript' in job:
+        return job['directScript']
+
+    return job['runScript']
+
+class JobTask:
+    """A job prepared for an executor (see executors.py)
+
+    Timing and resource usage of every phase are added to record.
+    State changes are written to run_journal, if given. resume is the last
+    journal entry of an interrupted run of this job. If a binary cache is
+    given, outputs are substituted from it instead of running the job.
     """
 
-    # Run all jobs in list
-    for name in jobnames:
-        print("Verify job {}".format(name))
-        job = jobset[name]
-        job["workdir"] = job["workdir"].strip('/') + "-validate"
+    def __init__(self, name: str, job: dict, dstore: str, global_launcher=None, record: dict = None,
+                 run_journal: journal.RunJournal = None, resume: dict = None, cache: substitute.BinaryCache = None):
+        self.name = name
+        self.job = job
+        self.dstore = dstore
+        self.record = record if record != None else {}
+        self.journal = run_journal
+        self.resume = resume
+        self.cache = cache
+        self.fingerprint = None
+        # output hashes, if substituted from the cache
+        self.substituted = None
+
+        if global_launcher == None:
+            self.launcher = job['jobLauncher']
+        else:
+            self.launcher = global_launcher
+
+    def prepare(self) -> bool:
+        """Import inputs and link them into the workdir
+
+            return: False if the job does not need to run, because the outputs
+                    of an interrupted run are adopted or substituted from the cache
+        """
+        workdir = os.path.expandvars(self.job['workdir'])
+
+        # Import inputs
+        with stats.phase(self.record, "inputs"):
+            inputs = import_input_paths(self.job, self.name, self.dstore)
 
-        run_job(name, job, dstore, global_launcher)
+        with stats.phase(self.record, "link"):
+            link_inputs_to_dir(inputs, "./", self.dstore, gcroots = True)
 
-        # compare with outputs from manifest
-        outputs_manifest = read_manifest(name)["outputs"]
-        for output in job["outputs"]:
-            print("Verify output {}".format(output))
-            hash = cas.hash_file("{}/{}".format(job['workdir'], output))
+            # Link inputs into workdir
+            link_inputs_to_dir(inputs, workdir, self.dstore)
 
-            if outputs_manifest[output] != hash:
-                print("Output {} of job {} can not be reproduced".format(output, name))
+        inputs = { file: inputs[file] for file in self.job['inputs'] }
+
+        # also needed to push adopted outputs
+        if self.cache != None:
+            self.fingerprint = substitute.fingerprint(self.job, inputs)
+
+        # The job has finished before, with the same inputs and function
+        r = self.resume
+        if r != None and r['state'] != journal.STARTED \
+                and r.get('inputs') == inputs and r.get('function') == self.job['runScript']:
+            print("Adopting outputs of job {} from {}".format(self.name, self.job['workdir']))
+            self.record['adopted'] = True
+            return False
+
+        if self.cache != None:
+            with stats.phase(self.record, "substitute"):
+                try:
+                    self.substituted = self.cache.substitute(self.fingerprint, self.dstore)
+                except Exception as err:
+                    # treat an unreadable or corrupted cache entry as a miss
+                    print("Can not substitute job {} from binary cache, running it: {}".format(self.name, err))
+                    self.substituted = None
+
+            if self.substituted != None:
+                print("Substituting outputs of job {} from binary cache".format(self.name))
+                self.record['substituted'] = True
                 return False
 
-            os.system("rm -r {}".format(job['workdir']))
+        if self.journal != None:
+            self.journal.record(self.name, journal.STARTED, inputs=inputs, function=self.job['runScript'])
 
-    return True
+        return True
 
-def run_job(name: str, job, dstore: str, global_launcher=None) -> None:
-    """ Run a single job
-    """
-    workdir = os.path.expandvars(job['workdir'])
+    def command(self) -> str:
+        return "{} {} \"{}\"".format(job_script(self.job), self.job['workdir'], self.launcher)
 
-    # Import inputs
-    inputs = import_input_paths(job, name, dstore)
-    link_inputs_to_dir(inputs, "./", dstore, gcroots = True)
+    def finish(self, ret: int) -> None:
+        """Check exit code and outputs of the job
+        """
+        if self.substituted != None:
+            return
 
-    # Link inputs into workdir
-    link_inputs_to_dir(inputs, workdir, dstore)
+        if ret != 0:
+            raise JobFailed("Running job {} failed!".format(self.name))
 
-    # Run job
-    if global_launcher == None:
-        launcher = job['jobLauncher']
-    else:
-        launcher = global_launcher
+        with stats.phase(self.record, "check") as p:
+            ret, usage = stats.run_command("{} {} {}".format(self.job['checkScript'], self.job['workdir'], " ".join(self.job['outputs'])))
+            p.update(usage)
+
+        if ret != 0:
+            raise JobFailed("Check for {} failed!".format(self.name))
+
+        if self.journal != None:
+            self.journal.record(self.name, journal.FINISHED)
 
-    print("Running job {}, {} ...".format(name, job['runScript']))
-    ret = os.system("{} {} \"{}\"".format(job['runScript'], job['workdir'], launcher))
-    if os.waitstatus_to_exitcode(ret) != 0:
-        print("Running job {} failed!".format(name))
-        exit(1)
+    def run(self) -> None:
+        if not self.prepare():
+            self.finish(0)
+            return
 
-    ret = os.system("{} {} {}".format(job['checkScript'], job['workdir'], " ".join(job['outputs'])))
-    if os.waitstatus_to_exitcode(ret) != 0:
-        print("Check for {} failed!".format(name))
-        exit(1)
+        print("Running job {}, {} ...".format(self.name, self.job['runScript']))
+        with stats.phase(self.record, "job") as p:
+            ret, usage = stats.run_command(self.command())
+            p.update(usage)
 
+        self.finish(ret)
 
-def import_outputs(job, name, dstore):
+def run_job(name: str, job, dstore: str, global_launcher=None, record: dict = None) -> None:
+    """ Run a single job
+
+        record: if given, timing and resource usage of every phase is added to it
+    """
+    JobTask(name, job, dstore, global_launcher, record).run()
+
+
+def import_outputs(job, name, dstore) -> dict[str, str]:
     """Import outputs of a job
+
+        return: hashes of the outputs, None if an output is missing
     """
 
     print("Importing outputs of job {}".format(name))
@@ -261,9 +400,26 @@ def import_outputs(job, name, dstore):
         outputs = import_output_paths(job, name, dstore)
     except FileNotFoundError as not_found:
         print("Output {} missing!".format(not_found.filename))
-        return
+        return None
+
+    link_outputs(outputs, dstore)
 
-    # Link outputs into dstore
+    print()
+
+    return outputs
+
+def substitute_outputs(name: str, outputs: dict[str, str], dstore: str) -> None:
+    """Record outputs fetched from a binary cache
+    """
+    m = read_manifest(name)
+    m['outputs'] = outputs
+    update_manifest(name, m)
+
+    link_outputs(outputs, dstore)
+
+def link_outputs(outputs: dict[str, str], dstore: str) -> None:
+    """Link outputs into the project
+    """
     try:
         os.makedirs("outputs")
     except FileExistsError:
@@ -273,16 +429,143 @@ def import_outputs(job, name, dstore):
         outName = "outputs/{}".format(file)
         cas.link_to_store(outName, hash, dstore, gcroot = True)
 
-    print()
-
 
-def run_jobs(jobset, jobnames: list[str], dstore: str, global_launcher=None) -> None:
+def run_jobs(jobset, jobnames: list[str], dstore: str, global_launcher=None, max_jobs: int = 1,
+             executor: executors.Executor = None, resume: bool = False,
+             cache: substitute.BinaryCache = None, push: bool = False, reevaluate: bool = False,
+             scope: set[str] = None) -> bool:
     """Run a list of jobs
+
+    Jobs are handed to the executor as soon as all of their dependencies in
+    jobnames have finished and their outputs are imported. By default up to
+    max_jobs jobs run concurrently on the local machine.
+    After a failure of a job, or any error while preparing it, no new jobs are
+    started, but running jobs are completed.
+
+    Every step is recorded in run_journal. With resume, jobs which have finished
+    in an interrupted run are not run again. Their outputs are taken from the
+    workdir, if inputs and function are unchanged and the check script succeeds.
+    The journal is removed once all jobs have succeeded.
+
+    Outputs of jobs found in the binary cache are substituted. With push, outputs
+    of jobs that have been run are published to the cache.
+
+    With reevaluate, the consumers of a job are checked again after its outputs
+    have been imported and are added to the run if they have become invalid.
+    Jobs waiting for dependencies are checked again before they start and are
+    skipped, if their dependencies have reproduced the previous outputs (early cutoff).
+    Only jobs in scope (default: all) are added by the re-evaluation.
+
+        return: True if all jobs succeeded
     """
-    for name in jobnames:
-        job = jobset[name]
-        run_job(name, job, dstore, global_launcher)
-        import_outputs(job, name, dstore)
+    if executor == None:
+        if max_jobs > 1:
+            executor = executors.PoolExecutor(max_jobs)
+        else:
+            executor = executors.LocalExecutor()
+
+    graph = dag.Dag(dag.dependencies(jobset))
+    deps = graph.deps
+    interrupted = run_journal.load() if resume else {}
+    run_log = stats.RunLog(os.path.join(cfgPath, "runs"))
+    pending = list(jobnames)
+    scheduled = set(jobnames)
+    waiting = { name: set(deps[name]) & scheduled for name in pending }
+    finished = set()
+    failed = False
+
+    try:
+        while pending or executor.running():
+            # Start all jobs whose dependencies are done
+            ready = not failed
+            while ready:
+                ready = False
+                for name in list(pending):
+                    if executor.running() >= executor.max_jobs:
+                        break
+
+                    if waiting[name] <= finished:
+                        pending.remove(name)
+
+                        if reevaluate and waiting[name] and check_job(name, jobset[name], dstore):
+                            print("Job {} is up to date, its inputs are unchanged".format(name))
+                            finished.add(name)
+                            # jobs waiting for this one may be ready now
+                            ready = True
+                            continue
+
+                        record = { 'job': name, 'start': time.time() }
+                        executor.submit(JobTask(name, jobset[name], dstore, global_launcher, record,
+                                                run_journal, interrupted.get(name), cache))
+
+            if not executor.running():
+                break
+
+            for task, err in executor.wait():
+                name = task.name
+                record = task.record
+                if err != None:
+                    if isinstance(err, JobFailed):
+                        print(err)
+                    else:
+                        print("Job {} failed: {}: {}".format(name, type(err).__name__, err))
+                    failed = True
+                    record['status'] = "failed"
+                else:
+                    with stats.phase(record, "import"):
+                        if task.substituted != None:
+                            outputs = task.substituted
+                            substitute_outputs(name, outputs, dstore)
+                        else:
+                            outputs = import_outputs(jobset[name], name, dstore)
+
+                        if outputs != None:
+                            run_journal.record(name, journal.HASHED, outputs=outputs)
+                            manifests.flush()
+                            run_journal.record(name, journal.IMPORTED)
+
+                    if outputs == None:
+                        # a missing output fails the job, its consumers must not run
+                        failed = True
+                        record['status'] = "failed"
+                    else:
+                        if push and task.substituted == None and task.fingerprint != None:
+                            with stats.phase(record, "push"):
+                                try:
+                                    cache.push(task.fingerprint, name, outputs, dstore)
+                                except Exception as push_err:
+                                    # the job itself has succeeded
+                                    print("Can not push outputs of job {} to binary cache: {}".format(name, push_err))
+                        record['status'] = "ok"
+                        finished.add(name)
+
+                        if reevaluate:
+                            for consumer in graph.consumers[name]:
+                                if consumer in scheduled or (scope != None and not consumer in scope):
+                                    continue
+
+                                if not check_job(consumer, jobset[consumer], dstore):
+                                    print("Job {} is invalidated by the outputs of {}".format(consumer, name))
+                                    scheduled.add(consumer)
+                                    pending.append(consumer)
+                                    waiting[consumer] = set(deps[consumer]) & scheduled
+
+                                    # pending jobs using its outputs have to wait for it
+                                    for p in pending:
+                                        if consumer in deps[p]:
+                                            waiting[p].add(consumer)
+
+                record['wall'] = time.time() - record['start']
+                run_log.write(record)
+    finally:
+        executor.close()
+
+    if pending:
+        print("Jobs not run: {}".format(" ".join(pending)))
+    elif not failed:
+        run_journal.clear()
+
+    return not failed
 
 def package_job(name: str, job):
     '''Re-write json definition for export/archival
@@ -316,29 +599,91 @@ def package_job(name: str, job):
 
     return job
 
-def copy_files_to_external(jobsets, targetDir: str, targetStore: str, dstore: str) -> None:
+def copy_files_to_external(jobsets, targetDir: str, targetStore: str, dstore: str, jobs: int = 1) -> list[str]:
     '''Export files for archived jobset
+
+    Only files missing in targetStore are copied, by up to jobs threads.
+    The links are created (or replaced) afterwards.
+
+        return: links created
     '''
+    hashes = set()
+    links = {}
     for _, job in jobsets.items():
 
-        # copy inputs
+        # inputs
         for file, hash in job['inputs'].items():
             if not is_output(file):
-                # copy file to to taget
-                if not os.path.exists("{}/{}".format(targetStore, hash)):
-                    os.system("cp {}/{} {}".format(dstore, hash, targetStore))
+                hashes.add(hash)
 
                 # create symlink to dstore
                 inputName = "{}/inputs/{}".format(targetDir, os.path.basename(file))
-                if not os.path.exists(inputName):
-                    cas.link_to_store(inputName, hash, targetStore, gcroot = True)
+                if not inputName in links:
+                    links[inputName] = hash
 
-        # copy outputs
+        # outputs
         for file, hash in job['outputs'].items():
-            # copy file to to taget
-            if not os.path.exists("{}/{}".format(targetStore, hash)):
-                os.system("cp {}/{} {}".format(dstore, hash, targetStore))
-            cas.link_to_store("{}/outputs/{}".format(targetDir, os.path.basename(file)), hash, targetStore, gcroot = True)
+            hashes.add(hash)
+            links["{}/outputs/{}".format(targetDir, os.path.basename(file))] = hash
+
+    # copy missing files to target, plain since all of them are linked
+    missing = [ hash for hash in hashes if not cas.hash_exists(hash, targetStore) ]
+    print("Copying {} of {} files".format(len(missing), len(hashes)))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        for future in [ pool.submit(cas.copy_object, hash, dstore, targetStore, False) for hash in missing ]:
+            future.result()
+
+    for link, hash in links.items():
+        cas.link_to_store(link, hash, targetStore, gcroot = True)
+
+    return list(links)
+
+def export_nar(path: str, targetStore: str) -> str:
+    '''Stream the NAR of a nix store path into targetStore
+
+        return: hash of the NAR
+    '''
+    process = subprocess.Popen(['nix-store', '--export', path], stdout=subprocess.PIPE)
+
+    try:
+        hash = cas.import_stream(process.stdout, targetStore)
+    finally:
+        process.stdout.close()
+        ret = process.wait()
+
+    if ret != 0:
+        raise Exception("nix-store --export {} failed".format(path))
+
+    return hash
+
+def export_nars(paths: list[str], narDir: str, targetStore: str, jobs: int = 1) -> list[str]:
+    '''Export NARs of nix store paths concurrently and link them into narDir
+
+    Nix store paths are immutable, NARs already linked in narDir are not exported again.
+
+        return: links to all NARs
+    '''
+    links = { "{}/{}.nar".format(narDir, os.path.basename(path)): path for path in paths }
+    missing = [ link for link in links if not os.path.exists(link) ]
+    print("Exporting {} of {} NARs".format(len(missing), len(links)))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = { pool.submit(export_nar, links[link], targetStore): link for link in missing }
+
+        for future in concurrent.futures.as_completed(futures):
+            cas.link_to_store(futures[future], future.result(), targetStore, gcroot = True)
+
+    return list(links)
+
+def remove_stale_links(dir: str, keep: list[str]) -> None:
+    '''Remove links in dir, which are not in keep
+    '''
+    keep = { os.path.normpath(link) for link in keep }
+
+    for entry in os.scandir(dir):
+        if entry.is_symlink() and not os.path.normpath(entry.path) in keep:
+            os.remove(entry.path)
 
 def collect_job_scripts(jobsets, scripts: list[str] = []) -> list[str]:
     ''' Collect all jobs scripts
@@ -0,0 +1,114 @@
+# SPDX-FileCopyrightText: 2022 Markus Kowalewski
+#
+# SPDX-License-Identifier: GPL-3.0-only
+
+import os
+import time
+import json
+import threading
+
+from . import utils
+from . import cas
+
+# Files modified this close (in ns) to the time they were hashed are
+# not trusted ("racily clean" in git terms). File systems with coarse
+# timestamps may otherwise hide a modification made right after hashing.
+RACY_WINDOW = 2 * 10**9
+
+# Version of the on-disk format
+FORMAT_VERSION = 1
+
+
+def stat_key(st: os.stat_result) -> list[int]:
+    """Stat fields that identify an unchanged file
+    """
+    return [st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns]
+
+class HashCache:
+    """Persistent cache of file hashes
+
+    Entries are keyed by the real path of a file and are only valid as long as
+    (st_dev, st_ino, st_size, st_mtime_ns, st_ctime_ns) are unchanged.
+    The cache file is loaded on first use.
+    """
+
+    def __init__(self, path: str = None):
+        self.path = path
+        self.entries = None
+        self.dirty = False
+        self.lock = threading.Lock()
+
+    def _load(self) -> None:
+        self.entries = {}
+
+        if self.path == None or not os.path.exists(self.path):
+            return
+
+        try:
+            data = utils.read_json(self.path)
+        except (OSError, json.JSONDecodeError):
+            # A broken cache is not fatal, files just get re-hashed
+            return
+
+        if data.get('version') == FORMAT_VERSION:
+            self.entries = data['entries']
+
+    def lookup(self, path: str, st: os.stat_result) -> str:
+        """Return the cached hash for path or None
+        """
+        with self.lock:
+            if self.entries == None:
+                self._load()
+
+            entry = self.entries.get(path)
+
+        if entry == None:
+            return None
+
+        key, hashed, sha256 = entry
+        if key != stat_key(st):
+            return None
+
+        if hashed - max(st.st_mtime_ns, st.st_ctime_ns) < RACY_WINDOW:
+            return None
+
+        return sha256
+
+    def hash_file(self, path: str, hash_func=None) -> str:
+        """Calculate the sha256 of a file, use cached value if file is unchanged
+
+            hash_func: function used to hash the file on a cache miss (default: cas.hash_file)
+        """
+        path = os.path.realpath(path)
+        st = os.stat(path)
+
+        sha256 = self.lookup(path, st)
+        if sha256 != None:
+            return sha256
+
+        hashed = time.time_ns()
+        if hash_func == None:
+            sha256 = cas.hash_file(path)
+        else:
+            sha256 = hash_func(path)
+
+        # Do not record files that have been modified while hashing
+        if stat_key(os.stat(path)) == stat_key(st):
+            with self.lock:
+                self.entries[path] = [stat_key(st), hashed, sha256]
+                self.dirty = True
+
+        return sha256
+
+    def save(self) -> None:
+        """Write cache to disk if it has changed
+        """
+        with self.lock:
+            if not self.dirty or self.path == None:
+                return
+
+            if not os.path.isdir(os.path.dirname(self.path) or "."):
+                return
+
+            utils.write_json_atomic(self.path, {'version': FORMAT_VERSION, 'entries': self.entries})
+            self.dirty = False
@@ -0,0 +1,65 @@
+# SPDX-FileCopyrightText: 2022 Markus Kowalewski
+#
+# SPDX-License-Identifier: GPL-3.0-only
+
+import os
+import json
+import time
+import threading
+
+
+# States of a job in the journal, in order
+STARTED = "started"
+FINISHED = "finished"
+HASHED = "hashed"
+IMPORTED = "imported"
+
+class RunJournal:
+    """Write-ahead journal of fspx run
+
+    Every state change of a job is appended as one JSON line and synced to disk,
+    before the run continues. After an interruption the journal tells which jobs
+    have finished, but have not been imported yet.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def record(self, name: str, state: str, **data) -> None:
+        entry = { 'job': name, 'state': state, 'time': time.time(), **data }
+
+        with self.lock:
+            with open(self.path, "a") as f:
+                f.write(json.dumps(entry) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+    def load(self) -> dict[str, dict]:
+        """Last known state of every job
+
+        Data of earlier entries (e.g. the inputs recorded at start) is merged into the last state.
+        """
+        jobs = {}
+        if not os.path.exists(self.path):
+            return jobs
+
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # torn write at the time of the crash
+                    continue
+
+                if entry['state'] == STARTED:
+                    jobs[entry['job']] = entry
+                else:
+                    jobs[entry['job']] = { **jobs.get(entry['job'], {}), **entry }
+
+        return jobs
+
+    def clear(self) -> None:
+        with self.lock:
+            if os.path.exists(self.path):
+                os.remove(self.path)
@@ -3,6 +3,9 @@
 # SPDX-License-Identifier: GPL-3.0-only
 
 import os
+import sys
+import random
+import atexit
 import argparse
 import subprocess
 import json
@@ -10,6 +13,11 @@ import json
 from . import utils
 from . import fspx
 from . import cas
+from . import dag
+from . import stats
+from . import executors
+from . import substitute
+from . import watch
 
 # Default path for project files
 cfgPath = fspx.cfgPath
@@ -44,11 +52,15 @@ def cmd_list(config) -> None:
     for name, _ in config['jobsets'].items():
         print(name)
 
-def cmd_check(config) -> tuple[list[str], bool]:
+def cmd_check(config, jobnames: list[str] = None) -> tuple[list[str], bool]:
     '''Check if job results are valid
+
+    If jobnames are given, only these jobs and their dependencies are checked.
     '''
 
-    jobs, valid = fspx.check_jobset(config['deps'], config['dstore'], recalc=[])
+    graph = dag.Dag.from_config(config)
+    scope = graph.upstream(jobnames) if jobnames else None
+    jobs, valid = fspx.check_jobs(graph, config['jobsets'], config['dstore'], scope)
 
     if not valid:
         print("The following jobs need to be re-run:")
@@ -58,6 +70,18 @@ def cmd_check(config) -> tuple[list[str], bool]:
 
     return jobs, valid
 
+def cmd_watch(config, run: bool = False, debounce: float = 1.0, poll: bool = False, jobnames: list[str] = None) -> None:
+    '''Watch inputs and manifests and report invalidated jobs
+
+    If jobnames are given, only these jobs and their dependencies are watched and run.
+    '''
+    scope = dag.Dag.from_config(config).upstream(jobnames) if jobnames else None
+
+    def run_jobs(jobs: list[str]) -> None:
+        fspx.run_jobs(config['jobsets'], jobs, config['dstore'], reevaluate = True, scope = scope)
+
+    watch.watch_jobs(config, debounce, poll, run_jobs if run else None, jobnames)
+
 def cmd_shell(config, jobname: str, dstore: str) -> None:
     '''Start a shell in a job environment
     '''
@@ -71,12 +95,21 @@ def cmd_shell(config, jobname: str, dstore: str) -> None:
     inputs = fspx.import_input_paths(job, jobname, dstore)
     fspx.link_inputs_to_dir(inputs, workdir, dstore)
 
-    print("Run nix-shell...")
-    os.system("cd {0}; nix-shell -p {1}".format(workdir, job['env']))
+    if 'envScript' in job:
+        print("Start shell...")
+        os.system("cd \"{0}\"; bash --rcfile {1}".format(workdir, job['envScript']))
+    else:
+        print("Run nix-shell...")
+        os.system("cd {0}; nix-shell -p {1}".format(workdir, job['env']))
 
 
-def cmd_export(config, toDir: str, targetStore: str) -> None:
+def cmd_export(config, toDir: str, targetStore: str, jobs: int = 4, incremental: bool = False) -> None:
     '''Export the project
+
+    Data files are copied and NARs exported by up to jobs concurrent workers.
+    In incremental mode an existing export in toDir is updated: only files and
+    NARs missing in targetStore are copied, links are replaced atomically and
+    links, which are not part of the project anymore, are removed.
     '''
 
     # Copy config file and update hashes
@@ -89,21 +122,26 @@ def cmd_export(config, toDir: str, targetStore: str) -> None:
     # Remove workdir (not needed in archive)
     config.pop("workdir")
     # Are not needed, can be recalculated, when needed.
-    config.pop("deps")
+    config.pop("deps", None)
+    config.pop("graph", None)
 
     # Copy inputs and outputs to archive
     print("Copying files to archive...")
-    os.makedirs(toDir)
-
-    os.mkdir("{}/inputs".format(toDir))
-    os.mkdir("{}/outputs".format(toDir))
+    dirs = [ toDir, "{}/inputs".format(toDir), "{}/outputs".format(toDir), "{}/nar".format(toDir) ]
+    if incremental:
+        for d in dirs:
+            os.makedirs(d, exist_ok=True)
+    else:
+        os.makedirs(toDir)
+        for d in dirs[1:]:
+            os.mkdir(d)
 
     try:
         os.makedirs(targetStore)
     except FileExistsError:
         None
 
-    fspx.copy_files_to_external(config['jobsets'], toDir, targetStore, config['dstore'])
+    links = fspx.copy_files_to_external(config['jobsets'], toDir, targetStore, config['dstore'], jobs)
 
     # Fix dstore
     config['dstore'] = os.path.relpath(targetStore, toDir)
@@ -118,17 +156,15 @@ def cmd_export(config, toDir: str, targetStore: str) -> None:
     print("Save job scripts to NAR archive...")
     allJobScripts = fspx.collect_job_scripts(config['jobsets'])
     nar_dir = "{}/nar".format(toDir)
-    os.mkdir(nar_dir)
 
-    out_paths = os.popen("nix-store -qR {}".format(" ".join(allJobScripts), toDir), 'r').read()
+    out_paths = subprocess.run(['nix-store', '-qR'] + allJobScripts,
+                               check=True, stdout=subprocess.PIPE, text=True).stdout.split()
+
+    links += fspx.export_nars(out_paths, nar_dir, targetStore, jobs)
 
-    for path in out_paths.split('\n'):
-        process = subprocess.Popen(['nix-store', '--export', path],
-                     stdout=subprocess.PIPE,
-                     stderr=subprocess.PIPE)
-        nar_data, _ = process.communicate()
-        hash = cas.import_data(nar_data, targetStore)
-        cas.link_to_store("{}/{}.nar".format(nar_dir, os.path.basename(path)), hash, targetStore, gcroot = True)
+    if incremental:
+        for d in dirs[1:]:
+            fspx.remove_stale_links(d, links)
 
 
 def cmd_init() -> None:
@@ -142,29 +178,79 @@ def cmd_init() -> None:
         except FileExistsError:
             None
 
-def cmd_run(config, job: str = None, launcher: str = None) -> None:
+def make_executor(args) -> executors.Executor:
+    '''Create the executor selected on the command line
+    '''
+    if args.executor == "slurm":
+        max_jobs = args.jobs if args.jobs != None else sys.maxsize
+        return executors.SlurmExecutor(max_jobs, os.path.join(cfgPath, "batch"), args.batch_options,
+                                       sbatch=args.sbatch, squeue=args.squeue, poll_interval=args.poll_interval,
+                                       scancel=args.scancel)
+
+    if args.jobs != None and args.jobs > 1:
+        return executors.PoolExecutor(args.jobs)
+
+    return executors.LocalExecutor()
+
+def cmd_run(config, job: str = None, launcher: str = None, executor: executors.Executor = None,
+            resume: bool = False, cache: str = None, push: bool = False,
+            upto: list[str] = None, impacted: list[str] = None) -> bool:
+    '''Run a job or all invalidated jobs
+
+    The invalidated jobs can be limited to the dependencies of the jobs in upto
+    and/or the jobs depending on those in impacted (both including the jobs themselves).
+    '''
+    if job != None and (upto or impacted):
+        raise Exception("A job name can not be combined with --upto or --impacted")
+
+    if cache != None:
+        cache = substitute.open_cache(cache)
+    elif push:
+        raise Exception("--push needs a binary cache (--cache)")
+
     if job == None:
-        jobs, valid = fspx.check_jobset(config['deps'], config['dstore'])
+        graph = dag.Dag.from_config(config)
+        scope = None
+        if upto:
+            scope = graph.upstream(upto)
+        if impacted:
+            scope = graph.downstream(impacted) if scope == None else scope & graph.downstream(impacted)
+
+        jobs, valid = fspx.check_jobs(graph, config['jobsets'], config['dstore'], scope)
         if not valid:
-            fspx.run_jobs(config['jobsets'], jobs, config['dstore'], global_launcher = launcher)
+            return fspx.run_jobs(config['jobsets'], jobs, config['dstore'], global_launcher = launcher, executor = executor,
+                                 resume = resume, cache = cache, push = push, reevaluate = True, scope = scope)
     else:
-        fspx.run_jobs(config['jobsets'], [ job ], config['dstore'], global_launcher = launcher)
+        return fspx.run_jobs(config['jobsets'], [ job ], config['dstore'], global_launcher = launcher, executor = executor,
+                             resume = resume, cache = cache, push = push)
+
+    return True
 
-def cmd_validate(config, job: str = None, launcher: str = None) -> None:
+def cmd_validate(config, job: str = None, launcher: str = None, jobs: int = 1, sample: int = None) -> bool:
 
     # make sure we have a valid job set by attempting to run all jobs
-    cmd_run(config, launcher = launcher)
+    if not cmd_run(config, launcher = launcher):
+        return False
 
     if job == None:
-        all_jobs = fspx.find_all_jobs(config['deps'])
-        fspx.validate_jobs(config['jobsets'], map(lambda j: j["name"], all_jobs), config['dstore'], global_launcher = launcher)
+        all_jobs = dag.Dag.from_config(config).order
+        if sample != None and sample < len(all_jobs):
+            all_jobs = random.sample(all_jobs, sample)
+        return fspx.validate_jobs(config['jobsets'], all_jobs, config['dstore'], global_launcher = launcher, jobs = jobs)
     else:
-        fspx.validate_jobs(config['jobsets'], [ job ], config['dstore'], global_launcher = launcher)
+        return fspx.validate_jobs(config['jobsets'], [ job ], config['dstore'], global_launcher = launcher)
 
 #
 # Main
 #
 
+def positive_int(value: str) -> int:
+    n = int(value)
+    if n < 1:
+        raise argparse.ArgumentTypeError("must be at least 1")
+
+    return n
+
 def main():
     argsMain = argparse.ArgumentParser(
             prog = "fspx",
@@ -179,35 +265,88 @@ def main():
 
     cmdArgs.add_parser("list", help="List job names.")
 
-    cmdArgs.add_parser("check", help="Check project and list invalidated jobs.")
+    argsCheck = cmdArgs.add_parser("check", help="Check project and list invalidated jobs.")
+    argsCheck.add_argument("jobs", nargs='*', help="Only check these jobs and their dependencies.")
+    argsCheck.add_argument("-w", "--watch", action="store_true", help="Keep checking jobs, whenever their inputs or manifests change.")
+    argsCheck.add_argument("--run", action="store_true", help="With --watch, run invalidated jobs after a change.")
+    argsCheck.add_argument("--debounce", type=float, default=1.0, help="With --watch, seconds without changes before jobs are checked.")
+    argsCheck.add_argument("--poll", action="store_true", help="With --watch, poll files instead of using inotify.")
 
     argsRun = cmdArgs.add_parser("run", help="Run jobs")
     argsRun.add_argument("job", nargs='?', help="Job to run. If ommited all invalidated jobs be run.")
     argsRun.add_argument("-l", "--launcher", help="Override job launcher.")
+    argsRun.add_argument("--upto", action="append", metavar="JOB", help="Only run invalidated jobs needed by JOB (can be repeated).")
+    argsRun.add_argument("--impacted", action="append", metavar="JOB", help="Only run invalidated jobs depending on JOB, including JOB (can be repeated).")
+    argsRun.add_argument("-j", "--jobs", type=positive_int, help="Number of jobs to run concurrently.")
+    argsRun.add_argument("--resume", action="store_true", help="Adopt outputs of jobs that finished in an interrupted run instead of re-running them.")
+    argsRun.add_argument("--cache", help="Binary cache (directory or URL) to substitute job outputs from.")
+    argsRun.add_argument("--push", action="store_true", help="Publish outputs of jobs that have been run to the binary cache.")
+    argsRun.add_argument("-e", "--executor", choices=["local", "slurm"], default="local", help="Run jobs locally or submit them to a batch system.")
+    argsBatch = argsRun.add_argument_group("batch system")
+    argsBatch.add_argument("--batch-options", default="", help="Extra options passed to sbatch.")
+    argsBatch.add_argument("--sbatch", default="sbatch", help="Command used to submit jobs.")
+    argsBatch.add_argument("--squeue", default="squeue", help="Command used to query the queue.")
+    argsBatch.add_argument("--scancel", default="scancel", help="Command used to cancel jobs, when the run is interrupted.")
+    argsBatch.add_argument("--poll-interval", type=float, default=10, help="Seconds between queue polls.")
 
     argsValidate = cmdArgs.add_parser("validate", help="Validate jobs by re-running them")
     argsValidate.add_argument("job", nargs='?', help="Jobs to run. If ommited all jobs will be run.")
     argsValidate.add_argument("-l", "--launcher", help="Override job launcher.")
+    argsValidate.add_argument("-j", "--jobs", type=positive_int, default=1, help="Number of jobs to validate concurrently.")
+    argsValidate.add_argument("--sample", type=positive_int, help="Only validate a random sample of this many jobs.")
+
+    argsStats = cmdArgs.add_parser("stats", help="Show timing and I/O statistics of previous runs.")
+    argsStats.add_argument("-n", "--top", type=int, help="Only show the slowest jobs.")
 
     argsShell = cmdArgs.add_parser("shell", help="Enter an interactive job shell environment.")
     argsShell.add_argument("job", help="Job to pick shell from.")
 
     argsExport = cmdArgs.add_parser("export", help="Export a finished project.")
-    argsExport.add_argument("target_dir", help="Target directory. Must be empty.")
+    argsExport.add_argument("target_dir", help="Target directory. Must be empty, unless --incremental is given.")
     argsExport.add_argument("target_store", help="Target data store directory.")
+    argsExport.add_argument("--incremental", action="store_true", help="Update an existing export, copy only what is missing in the target store.")
+    argsExport.add_argument("-j", "--jobs", type=positive_int, default=4, help="Number of concurrent copies and NAR exports.")
 
     argsImport = cmdArgs.add_parser("store-import", help="Import files into data store manually.")
     argsImport.add_argument("file_name", help="File to import.")
     argsImport.add_argument("link_name", help="Link name to create")
+    argsImport.add_argument("--hardlink", action="store_true", help="Hardlink the file into the store if possible. This makes the file read-only.")
 
     argsCheckCAS = cmdArgs.add_parser("store-check", help="Check if store entries are valid")
     argsCheckCAS.add_argument("dstore", help="Path to data store")
+    argsCheckCAS.add_argument("-j", "--jobs", type=positive_int, default=1, help="Number of files to hash concurrently.")
+    argsCheckCAS.add_argument("--incremental", action="store_true", help="Only verify files that are new or changed since the last check.")
+    argsCheckCAS.add_argument("--sample", type=float, default=0.0, help="With --incremental, fraction of unchanged files to re-verify anyway.")
+    argsCheckCAS.add_argument("--max-age", type=float, help="With --incremental, re-verify files last verified more than this many days ago.")
 
     argsGC = cmdArgs.add_parser("store-gc", help="garbage collect unlinked entries from data store")
     argsGC.add_argument("dstore", help="Path to data store")
+    argsGC.add_argument("-n", "--dry-run", action="store_true", help="Only list files that would be removed.")
+    argsGC.add_argument("--max-bytes", type=int, help="Stop after this many bytes have been freed.")
+
+    argsMigrate = cmdArgs.add_parser("store-migrate", help="Convert data store to another directory layout")
+    argsMigrate.add_argument("dstore", help="Path to data store")
+    argsMigrate.add_argument("layout", choices=cas.LAYOUTS.keys(), help="Target layout. Sharded stores use sub-directories ab/cd/<hash>.")
+
+    argsChunk = cmdArgs.add_parser("store-chunk", help="Store large files as deduplicated chunks")
+    argsChunk.add_argument("dstore", help="Path to data store")
+    argsChunk.add_argument("--min-size", type=int, default=64 << 20, help="Minimum file size in bytes (default 64 MiB).")
+
+    argsCompress = cmdArgs.add_parser("store-compress", help="Compress files, which compress well and have not been used recently")
+    argsCompress.add_argument("dstore", help="Path to data store")
+    argsCompress.add_argument("--min-size", type=int, default=4096, help="Minimum file size in bytes (default 4 KiB).")
+    argsCompress.add_argument("--min-age", type=float, help="Only compress files not used for this many days.")
+
+    argsMaterialize = cmdArgs.add_parser("store-materialize", help="Restore chunked or compressed files")
+    argsMaterialize.add_argument("dstore", help="Path to data store")
+    argsMaterialize.add_argument("links", nargs='*', help="Links to files in the data store. If ommited all chunked and compressed files are restored.")
 
     args = argsMain.parse_args()
 
+    # Persist hashes of unchanged inputs and manifests, also when a command exits early
+    atexit.register(fspx.hash_cache.save)
+    atexit.register(fspx.manifests.flush)
+
     if args.command == None:
         argsMain.print_help()
         exit(1)
@@ -221,15 +360,50 @@ def main():
         exit(ret)
 
     elif args.command == "store-check":
-        if not cas.verify_store(args.dstore):
+        max_age = None if args.max_age == None else args.max_age * 86400
+        if not cas.verify_store(args.dstore, args.jobs, args.incremental, args.sample, max_age):
             exit(1)
 
         print("Store in {} is OK.".format(args.dstore))
         exit(0)
 
     elif args.command == "store-gc":
-        n = cas.clean_garbage(args.dstore)
-        print("Removed {} files from data store".format(n))
+        n, size = cas.clean_garbage(args.dstore, args.dry_run, args.max_bytes)
+        if args.dry_run:
+            print("Would remove {} files ({:.1f} MiB) from data store".format(n, size / (1 << 20)))
+        else:
+            print("Removed {} files ({:.1f} MiB) from data store".format(n, size / (1 << 20)))
+        exit(0)
+
+    elif args.command == "store-migrate":
+        n = cas.migrate_store(args.dstore, cas.LAYOUTS[args.layout])
+        print("Moved {} files in data store {}".format(n, args.dstore))
+        exit(0)
+
+    elif args.command == "store-chunk":
+        n, size = cas.chunk_store(args.dstore, args.min_size)
+        print("Replaced {} files ({:.1f} MiB) by chunks in data store {}".format(n, size / (1 << 20), args.dstore))
+        exit(0)
+
+    elif args.command == "store-compress":
+        min_age = None if args.min_age == None else args.min_age * 86400
+        n, saved = cas.compress_store(args.dstore, args.min_size, min_age)
+        print("Compressed {} files in data store {}, saved {:.1f} MiB".format(n, args.dstore, saved / (1 << 20)))
+        exit(0)
+
+    elif args.command == "store-materialize":
+        if args.links:
+            hashes = [ cas.hash_from_store_path(link, args.dstore) for link in args.links ]
+        else:
+            hashes = { cas.object_hash(file.name) for file in cas.iter_objects(args.dstore)
+                       if not cas.is_valid_name(file.name) } - { None }
+
+        for hash in hashes:
+            cas.materialize(hash, args.dstore)
+        exit(0)
+
+    elif args.command == "stats":
+        stats.print_stats(os.path.join(cfgPath, "runs"), args.top)
         exit(0)
 
     # Read the config. Every command from here on will need it
@@ -238,29 +412,36 @@ def main():
     if args.command == "list":
         cmd_list(config)
 
+    elif args.command == "check" and args.watch:
+        cmd_watch(config, args.run, args.debounce, args.poll, args.jobs)
+
     elif args.command == "check":
-        _, valid = cmd_check(config)
+        _, valid = cmd_check(config, args.jobs)
         if not valid:
             exit(1)
 
     elif args.command == "run":
-        cmd_run(config, args.job, args.launcher)
+        if not cmd_run(config, args.job, args.launcher, make_executor(args), args.resume, args.cache, args.push,
+                       args.upto, args.impacted):
+            exit(1)
 
     elif args.command == "validate":
-        cmd_validate(config, args.job, args.launcher)
+        if not cmd_validate(config, args.job, args.launcher, args.jobs, args.sample):
+            exit(1)
 
     elif args.command == "shell":
         cmd_shell(config, args.job, config['dstore'])
 
     elif args.command == "export":
-        if not cmd_check(config):
+        _, valid = cmd_check(config)
+        if not valid:
             print("Project data is not valid. Can not export project.")
             exit(1)
 
-        cmd_export(config, args.target_dir, args.target_store)
+        cmd_export(config, args.target_dir, args.target_store, args.jobs, args.incremental)
 
     elif args.command == "store-import":
-        paths = cas.import_paths([ args.file_name ], config['dstore'])
+        paths = cas.import_paths([ args.file_name ], config['dstore'], cache=fspx.hash_cache, hardlink=args.hardlink)
         cas.link_to_store(args.link_name, paths[args.file_name], config['dstore'], gcroot = True)
 
 
@@ -0,0 +1,77 @@
+# SPDX-FileCopyrightText: 2022 Markus Kowalewski
+#
+# SPDX-License-Identifier: GPL-3.0-only
+
+import os
+import copy
+import threading
+
+from . import utils
+
+
+def empty_manifest() -> dict:
+    return {'inputs':{}, 'function':"", 'outputs':{}}
+
+class ManifestStore:
+    """Job manifests of a project
+
+    Every manifest is read at most once. Changes are kept in memory
+    until flush() writes the modified manifests, each one atomically.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.manifests = {}
+        self.dirty = set()
+        self.lock = threading.Lock()
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, "{}.manifest".format(name))
+
+    def _load(self, name: str) -> dict:
+        if not name in self.manifests:
+            mfile = self._file(name)
+            if os.path.exists(mfile):
+                self.manifests[name] = utils.read_json(mfile)
+            else:
+                self.manifests[name] = None
+
+        return self.manifests[name]
+
+    def get(self, name: str) -> dict:
+        """Return a copy of the manifest of job name
+        """
+        with self.lock:
+            m = self._load(name)
+
+        if m == None:
+            return empty_manifest()
+
+        return copy.deepcopy(m)
+
+    def update(self, name: str, data: dict) -> None:
+        """Merge data into the manifest of job name
+        """
+        with self.lock:
+            m = self._load(name) or {}
+            self.manifests[name] = { **m, **copy.deepcopy(data) }
+            self.dirty.add(name)
+
+    def flush(self) -> None:
+        """Write all modified manifests
+        """
+        with self.lock:
+            for name in sorted(self.dirty):
+                utils.write_json_atomic(self._file(name), self.manifests[name])
+
+            self.dirty.clear()
+
+    def discard(self, name: str) -> None:
+        """Forget the loaded manifest of job name, it is read again on the next access
+
+        Used when the manifest file has been changed by another process.
+        Unsaved changes are kept.
+        """
+        with self.lock:
+            if not name in self.dirty:
+                self.manifests.pop(name, None)
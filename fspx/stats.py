@@ -0,0 +1,127 @@
+# SPDX-FileCopyrightText: 2022 Markus Kowalewski
+#
+# SPDX-License-Identifier: GPL-3.0-only
+
+import os
+import json
+import time
+import glob
+import threading
+import contextlib
+
+from . import cas
+
+
+def run_command(cmd: str) -> tuple[int, dict]:
+    """Run a shell command and collect its resource usage
+
+        return: exit code, usage of the command and its children
+    """
+    pid = os.posix_spawn("/bin/sh", ["/bin/sh", "-c", cmd], os.environ)
+    _, status, rusage = os.wait4(pid, 0)
+
+    usage = {
+        'cpu_user': rusage.ru_utime,
+        'cpu_system': rusage.ru_stime,
+        'max_rss_kib': rusage.ru_maxrss,
+    }
+
+    return os.waitstatus_to_exitcode(status), usage
+
+@contextlib.contextmanager
+def phase(record: dict, name: str):
+    """Record wall time, CPU time and I/O of the calling thread for a phase of a job
+    """
+    io = dict(cas.io_counters())
+    cpu = time.thread_time()
+    start = time.monotonic()
+
+    p = record.setdefault('phases', {}).setdefault(name, {})
+    try:
+        yield p
+    finally:
+        p['wall'] = time.monotonic() - start
+        p['cpu'] = time.thread_time() - cpu
+        p['bytes_hashed'] = cas.io_counters()['hashed'] - io['hashed']
+        p['bytes_copied'] = cas.io_counters()['copied'] - io['copied']
+
+class RunLog:
+    """Log of job records, one JSON object per line
+
+    Every invocation writes its own file in path, which is created on the first record.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.file = os.path.join(path, "{}-{}.jsonl".format(time.strftime("%Y%m%d-%H%M%S"), os.getpid()))
+        self.lock = threading.Lock()
+
+    def write(self, record: dict) -> None:
+        with self.lock:
+            os.makedirs(self.path, exist_ok=True)
+            with open(self.file, "a") as f:
+                f.write(json.dumps(record) + "\n")
+
+def read_records(path: str) -> list[dict]:
+    """Read all job records from the run logs in path
+    """
+    records = []
+    for file in sorted(glob.glob(os.path.join(path, "*.jsonl"))):
+        with open(file) as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    # incomplete last line of an interrupted run
+                    pass
+
+    return records
+
+def aggregate(records: list[dict]) -> dict[str, dict]:
+    """Sum up the records per job
+    """
+    jobs = {}
+    for r in records:
+        j = jobs.setdefault(r['job'], { 'runs': 0, 'failed': 0, 'wall': 0.0, 'max_wall': 0.0, 'phases': {} })
+        j['runs'] += 1
+        if r.get('status') != "ok":
+            j['failed'] += 1
+        j['wall'] += r.get('wall', 0.0)
+        j['max_wall'] = max(j['max_wall'], r.get('wall', 0.0))
+
+        for name, p in r.get('phases', {}).items():
+            jp = j['phases'].setdefault(name, {})
+            for key, value in p.items():
+                jp[key] = jp.get(key, 0) + value
+
+    return jobs
+
+def print_stats(path: str, top: int = None) -> None:
+    """Print a table of jobs sorted by mean wall time
+    """
+    jobs = aggregate(read_records(path))
+    if not jobs:
+        print("No runs recorded in {}".format(path))
+        return
+
+    names = sorted(jobs, key=lambda n: jobs[n]['wall'] / jobs[n]['runs'], reverse=True)
+    if top != None:
+        names = names[:top]
+
+    print("{:<24} {:>5} {:>6} {:>10} {:>10} {:>10} {:>10} {:>10} {:>10} {:>10} {:>10} {:>12}".format(
+        "job", "runs", "failed", "wall [s]", "max [s]", "inputs", "link", "job", "check", "import", "cache", "hashed [MiB]"))
+
+    for name in names:
+        j = jobs[name]
+        n = j['runs']
+
+        def mean(phase: str, key: str = 'wall') -> float:
+            return j['phases'].get(phase, {}).get(key, 0) / n
+
+        hashed = sum(p.get('bytes_hashed', 0) for p in j['phases'].values()) / n
+
+        # binary cache: substitution and push
+        print("{:<24} {:>5} {:>6} {:>10.2f} {:>10.2f} {:>10.2f} {:>10.2f} {:>10.2f} {:>10.2f} {:>10.2f} {:>10.2f} {:>12.1f}".format(
+            name, n, j['failed'], j['wall'] / n, j['max_wall'],
+            mean("inputs"), mean("link"), mean("job"), mean("check"), mean("import"),
+            mean("substitute") + mean("push"), hashed / (1 << 20)))
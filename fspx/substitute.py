@@ -0,0 +1,127 @@
+# SPDX-FileCopyrightText: 2022 Markus Kowalewski
+#
+# SPDX-License-Identifier: GPL-3.0-only
+
+'''Binary cache for job outputs
+
+A job is identified by a fingerprint of its function (runScript) and the hashes
+of its inputs. A cache maps fingerprints to the hashes of the outputs and holds
+the output files. Instead of running a job with a known fingerprint, its outputs
+are copied from the cache into the data store.
+'''
+
+import os
+import abc
+import json
+import hashlib
+
+from . import cas
+from . import utils
+
+
+def fingerprint(job: dict, inputs: dict[str, str]) -> str:
+    """Fingerprint of a job, sha256 over its function, input hashes and output names
+    """
+    key = { 'function': job['runScript'], 'inputs': sorted(inputs.items()), 'outputs': sorted(job['outputs']) }
+    return hashlib.sha256(json.dumps(key).encode()).hexdigest()
+
+class BinaryCache(abc.ABC):
+    """Interface of all cache transports
+    """
+
+    @abc.abstractmethod
+    def lookup(self, fp: str) -> dict:
+        """Return the output hashes of a fingerprint or None
+        """
+
+    @abc.abstractmethod
+    def fetch(self, hash: str, dstore: str) -> None:
+        """Copy an object from the cache into dstore and verify it
+        """
+
+    @abc.abstractmethod
+    def push(self, fp: str, job: str, outputs: dict[str, str], dstore: str) -> None:
+        """Publish the outputs of a job
+        """
+
+    def substitute(self, fp: str, dstore: str) -> dict[str, str]:
+        """Fetch all outputs of a fingerprint into dstore
+
+            return: hashes of the outputs, None if the cache has no complete entry
+        """
+        outputs = self.lookup(fp)
+        if outputs == None:
+            return None
+
+        for hash in outputs.values():
+            if not cas.hash_exists(hash, dstore):
+                self.fetch(hash, dstore)
+
+        return outputs
+
+class LocalCache(BinaryCache):
+    """Cache in a local directory or on a shared file system
+
+    Layout:
+        fingerprints/<fingerprint>.json  job name and output hashes
+        store/                           data store with the output files
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.store = os.path.join(path, "store")
+
+    def _info(self, fp: str) -> str:
+        return os.path.join(self.path, "fingerprints", "{}.json".format(fp))
+
+    def lookup(self, fp: str) -> dict:
+        try:
+            info = utils.read_json(self._info(fp))
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+        # objects may have been removed from the cache
+        for hash in info['outputs'].values():
+            if not cas.hash_exists(hash, self.store):
+                return None
+
+        return info['outputs']
+
+    def fetch(self, hash: str, dstore: str) -> None:
+        # The cache may be shared, verify what is copied
+        tmp = cas.tmp_path(dstore)
+        try:
+            if cas.copy_and_hash_object(hash, self.store, tmp) != hash:
+                raise Exception("Object {} in binary cache {} is corrupted".format(hash, self.path))
+            cas.add_to_store(tmp, hash, dstore)
+        except BaseException:
+            if os.path.lexists(tmp):
+                os.remove(tmp)
+            raise
+
+    def push(self, fp: str, job: str, outputs: dict[str, str], dstore: str) -> None:
+        os.makedirs(self.store, exist_ok=True)
+        os.makedirs(os.path.dirname(self._info(fp)), exist_ok=True)
+
+        # objects first, the entry becomes visible once all outputs are present
+        for hash in outputs.values():
+            cas.copy_object(hash, dstore, self.store)
+
+        utils.write_json_atomic(self._info(fp), { 'job': job, 'outputs': outputs })
+
+# Transports by URL scheme, paths without scheme are local directories
+transports = {
+    'file': LocalCache,
+}
+
+def open_cache(url: str) -> BinaryCache:
+    """Open the cache at url, e.g. /shared/cache or file:///shared/cache
+    """
+    scheme, sep, path = url.partition("://")
+    if sep == "":
+        return LocalCache(url)
+
+    if not scheme in transports:
+        raise Exception("Unknown binary cache transport {}".format(scheme))
+
+    return transports[scheme](path)
@@ -2,7 +2,9 @@
 #
 # SPDX-License-Identifier: GPL-3.0-only
 
+import os
 import json
+import tempfile
 
 def read_json(path):
     with open(path, "rb") as f:
@@ -12,4 +14,22 @@ def write_json(path, js):
     with open(path, "w") as jsfile:
         json.dump(js, jsfile)
 
+def write_json_atomic(path, js):
+    """Write json to a temporary file and rename it into place
 
+    Readers either see the old or the new file, never a truncated one.
+    """
+    dir = os.path.dirname(path) or "."
+    fd, tmp = tempfile.mkstemp(dir=dir, prefix=".{}.".format(os.path.basename(path)))
+    try:
+        try:
+            os.fchmod(fd, os.stat(path).st_mode & 0o777)
+        except FileNotFoundError:
+            os.fchmod(fd, 0o644)
+
+        with os.fdopen(fd, "w") as jsfile:
+            json.dump(js, jsfile)
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
@@ -0,0 +1,311 @@
+# SPDX-FileCopyrightText: 2022 Markus Kowalewski
+#
+# SPDX-License-Identifier: GPL-3.0-only
+
+'''Keep the validity of jobs up to date while files change
+
+Raw inputs, the links in outputs/ and the manifests are watched with
+inotify, or by polling where inotify is not available. Only the jobs
+affected by a changed file are checked again.
+'''
+
+import os
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+
+from . import fspx
+from . import dag
+
+
+# inotify constants (sys/inotify.h)
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_MOVE_SELF
+
+_EVENT = struct.Struct("iIII")
+
+class InotifyWatcher:
+    """Watch files through inotify on their directories
+
+    Directories are watched instead of the files, so that files replaced
+    by a rename (manifests, links) are still seen. A directory, which does
+    not exist (yet), is watched through its nearest existing parent, until
+    it is created.
+    """
+
+    def __init__(self, paths: list[str]):
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+
+        self.paths = set(paths)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+
+        # watch descriptor -> directory, directory -> watch descriptor
+        self.dirs = {}
+        self.wds = {}
+        try:
+            for dir in { os.path.dirname(p) for p in self.paths }:
+                self._watch(dir)
+        except BaseException:
+            os.close(self.fd)
+            raise
+
+    def _watch(self, dir: str) -> None:
+        """Watch dir or its nearest existing parent
+        """
+        while True:
+            while not os.path.isdir(dir):
+                dir = os.path.dirname(dir)
+
+            if dir in self.wds:
+                return
+
+            wd = self.libc.inotify_add_watch(self.fd, dir.encode(), WATCH_MASK)
+            if wd >= 0:
+                break
+
+            # removed in the meantime, try the parent again
+            err = ctypes.get_errno()
+            if err != errno.ENOENT:
+                raise OSError(err, os.strerror(err), dir)
+
+        self.dirs[wd] = dir
+        self.wds[dir] = wd
+
+    def _rewatch(self, path: str) -> set[str]:
+        """Update the watches after path has been created or removed
+
+            return: watched files below path
+        """
+        below = { p for p in self.paths if p.startswith(path + os.sep) }
+        for dir in { os.path.dirname(p) for p in below }:
+            self._watch(dir)
+
+        return below
+
+    def wait(self, timeout: float = None) -> set[str]:
+        """Wait for changes of the watched files
+
+            return: changed files, empty if the timeout has expired
+        """
+        changed = set()
+        deadline = None if timeout == None else time.monotonic() + timeout
+
+        while not changed:
+            remaining = None if deadline == None else max(0, deadline - time.monotonic())
+            ready, _, _ = select.select([ self.fd ], [], [], remaining)
+            if not ready:
+                return changed
+
+            try:
+                data = os.read(self.fd, 1 << 16)
+            except BlockingIOError:
+                continue
+
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = _EVENT.unpack_from(data, offset)
+                name = data[offset + _EVENT.size : offset + _EVENT.size + length].rstrip(b"\0").decode()
+                offset = offset + _EVENT.size + length
+
+                if mask & IN_Q_OVERFLOW:
+                    # events have been lost
+                    return set(self.paths)
+
+                dir = self.dirs.get(wd)
+                if dir == None:
+                    continue
+
+                if mask & IN_MOVE_SELF:
+                    # the watch would follow the directory, it is replaced when IN_IGNORED arrives
+                    self.libc.inotify_rm_watch(self.fd, wd)
+                    continue
+
+                if mask & IN_IGNORED:
+                    # the directory has been removed or moved, watch its parent instead
+                    del self.dirs[wd]
+                    del self.wds[dir]
+                    changed |= self._rewatch(dir)
+                    continue
+
+                path = os.path.join(dir, name)
+                if path in self.paths:
+                    changed.add(path)
+                elif mask & (IN_CREATE | IN_MOVED_TO):
+                    # a directory on the way to watched files, which may exist already
+                    changed |= self._rewatch(path)
+
+        return changed
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+class PollWatcher:
+    """Watch files by comparing their stat information every interval seconds
+    """
+
+    def __init__(self, paths: list[str], interval: float = 1.0):
+        self.interval = interval
+        self.state = { p: self._stat(p) for p in paths }
+
+    def _stat(self, path: str):
+        try:
+            st = os.lstat(path)
+        except FileNotFoundError:
+            return None
+
+        return (st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns)
+
+    def wait(self, timeout: float = None) -> set[str]:
+        deadline = None if timeout == None else time.monotonic() + timeout
+
+        while True:
+            changed = set()
+            for path, old in self.state.items():
+                new = self._stat(path)
+                if new != old:
+                    self.state[path] = new
+                    changed.add(path)
+
+            if changed:
+                return changed
+
+            if deadline != None and time.monotonic() >= deadline:
+                return changed
+
+            time.sleep(self.interval if deadline == None else min(self.interval, max(0, deadline - time.monotonic())))
+
+    def close(self) -> None:
+        pass
+
+def make_watcher(paths: list[str], poll: bool = False):
+    """Use inotify if available, fall back to polling
+    """
+    if not poll:
+        try:
+            return InotifyWatcher(paths)
+        except (OSError, AttributeError) as err:
+            if isinstance(err, OSError) and err.errno == errno.ENOSPC:
+                print("Too many inotify watches, polling instead")
+
+    return PollWatcher(paths)
+
+def watched_files(jobsets: dict) -> dict[str, set[str]]:
+    """Map files to the jobs whose validity depends on them
+    """
+    files = {}
+    for name, job in jobsets.items():
+        paths = [ os.path.join(fspx.cfgPath, "{}.manifest".format(name)) ]
+        paths.extend(fspx.to_outpath(file) for file in job['inputs'])
+
+        for p in paths:
+            files.setdefault(os.path.abspath(os.path.expandvars(p)), set()).add(name)
+
+    return files
+
+def collect(watcher, quiet: float) -> set[str]:
+    """Collect changes until no change has been seen for quiet seconds
+    """
+    changed = set()
+    while True:
+        more = watcher.wait(quiet)
+        if not more:
+            return changed
+        changed |= more
+
+def print_invalid(order: list[str], valid: dict[str, bool]) -> None:
+    invalid = [ name for name in order if not valid[name] ]
+    if invalid:
+        print("{} The following jobs need to be re-run: {}".format(time.strftime("%H:%M:%S"), " ".join(invalid)))
+    else:
+        print("{} All jobs are valid".format(time.strftime("%H:%M:%S")))
+
+def watch_jobs(config: dict, debounce: float = 1.0, poll: bool = False, run=None,
+               jobnames: list[str] = None) -> None:
+    """Check jobs whenever files they depend on change, until interrupted
+
+    Changes are collected until no event has arrived for debounce seconds.
+    If run is given, it is called with the list of invalid jobs at startup
+    and after every change that affects an invalid job, also when a
+    previous run has failed; changes made by the run itself do not trigger
+    another run.
+    If jobnames are given, only these jobs and their dependencies are watched.
+    """
+    jobsets = config['jobsets']
+    dstore = config['dstore']
+    graph = dag.Dag.from_config(config)
+    order = graph.sorted(graph.upstream(jobnames)) if jobnames else graph.order
+
+    files = watched_files({ name: jobsets[name] for name in order })
+    watcher = make_watcher(list(files), poll)
+    print("Watching {} files of {} jobs ({})".format(len(files), len(order), type(watcher).__name__))
+
+    valid = { name: fspx.check_job(name, jobsets[name], dstore) for name in order }
+    print_invalid(order, valid)
+
+    def update(changed: set[str], jobs: list[str] = []) -> set[str]:
+        """Check the jobs affected by changed files again
+
+            return: affected jobs
+        """
+        affected = set(jobs)
+        for path in changed:
+            affected |= files[path]
+            if path.endswith(".manifest"):
+                for name in files[path]:
+                    fspx.manifests.discard(name)
+
+        for name in graph.sorted(affected):
+            valid[name] = fspx.check_job(name, jobsets[name], dstore)
+
+        return affected
+
+    def run_invalid() -> None:
+        invalid = [ name for name in order if not valid[name] ]
+        run(invalid)
+
+        # take in the changes made by the run, without triggering another one
+        update(collect(watcher, 0), invalid)
+        print_invalid(order, valid)
+
+    try:
+        if run != None and not all(valid.values()):
+            run_invalid()
+
+        while True:
+            changed = watcher.wait()
+
+            # debounce, e.g. an editor saving several files
+            changed |= collect(watcher, debounce)
+
+            before = dict(valid)
+            affected = update(changed)
+            if valid == before and all(valid[name] for name in affected):
+                continue
+
+            print_invalid(order, valid)
+            fspx.hash_cache.save()
+
+            # jobs that stay invalid are run again, e.g. after a failed run
+            if run != None and not all(valid.values()):
+                run_invalid()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
@@ -172,6 +172,8 @@ in {
             }
           else job.env;
 	    runScript = nixShell name job env;
+	    envScript = realizeEnv name env;
+	    directScript = directShell name job envScript;
 	  } // optionalAttrs (job.workdir == null) {
 	    workdir = cfg.workdir + "/" + name;
 	  });
@@ -189,6 +191,38 @@ in {
         $launcher ${job.jobScript}
       '';
 
+      # Environment of "nix-shell -p env", realized at build time.
+      # The stdenv setup runs once in the build and the resulting variables
+      # are written to a script, which can be sourced without evaluating nix-shell.
+      realizeEnv = name: env: pkgs.runCommand "${name}-env" { buildInputs = [ env ]; } ''
+        touch $out
+        for var in $(compgen -e); do
+          case "$var" in
+            PATH|HOME|PWD|OLDPWD|SHLVL|TERM|TMP|TMPDIR|TEMP|TEMPDIR|NIX_BUILD_TOP|NIX_BUILD_CORES|NIX_LOG_FD|NIX_STORE|NIX_SSL_CERT_FILE|SSL_CERT_FILE|out|builder|buildCommand|buildCommandPath|passAsFile|name|system)
+              ;;
+            *)
+              printf 'export %s=%q\n' "$var" "''${!var}" >> $out
+              ;;
+          esac
+        done
+        printf 'export PATH=%q:"$PATH"\n' "$PATH" >> $out
+      '';
+
+      # Same as nixShell, but sources the pre-realized environment.
+      # nixShell is kept unchanged, it identifies the job function in the manifests.
+      directShell = name: job: envScript: pkgs.writeScript "directShell" ''
+        #!${pkgs.runtimeShell}
+        source ${envScript}
+
+        cd "$1"
+        if [ -z "$2" ]; then
+          launcher=""
+        else
+          launcher="$2"
+        fi
+        $launcher ${job.jobScript}
+      '';
+
       project = builtins.removeAttrs (config // { jobsets = fixJobsets config.jobsets; }) [ "outPath" "_module" "nixpkgs" ];
 
       allOutputs = let
@@ -204,50 +238,31 @@ in {
       # Remap inputs to { input = jobname; }
       inputsMap = builtins.listToAttrs (flatten (mapAttrsToList (name: job: (map (x: nameValuePair x name ) (attrNames job.inputs)) ) project.jobsets));
 
-      deps = let
+      # Flat dependency graph { job = [ direct dependencies ]; }
+      graph = let
         # Used to strip leading colon
         # stripFirst :: str -> str
         stripFirst = x: substring 1 (stringLength x) x;
 
-        # map input name to job name, remove original inputs, clear leading colon
-        # input2jobs :: attrs(input/hash) -> attrs(input/jobs)
-        inputs2jobs = inputs: listToAttrs (filter (x: x != null) (mapAttrsToList (input: hash:
+        # map inputs to the names of the jobs producing them
+        # inputs2jobs :: attrs(input/hash) -> [ str ]
+        inputs2jobs = inputs: unique (filter (x: x != null) (mapAttrsToList (input: hash:
             if hasPrefix ":" input then
               if hasAttr (stripFirst input) outputsMap then
-                let
-                  name = getAttr (stripFirst input) outputsMap;
-                in {
-            inherit name;
-            value = getAttr name project.jobsets;
-                }
+                getAttr (stripFirst input) outputsMap
               else throw "${input} is not produced by any job!"
             else null
                 ) inputs));
 
-        # find jobs where outputs are not used by any other job
-              # filterTopLevel :: attrs(jobset) -> attrs(jobset)
-        filterTopLevel = filterAttrs (name: job:
-              foldr (a: b:
-          (! (hasAttr ":${a}" (filterAttrs (n: j: j != name) inputsMap))) && b)
-              true job.outputs
-            );
-
-        # Create dependency tree
-        # collectDeps :: attrs(jobset) -> attrs(deps)
-        collectDeps = jobsets: (mapAttrs (name: job: {
-              inherit (job) inputs outputs runScript;
-              deps = collectDeps (inputs2jobs job.inputs);
-              } ) jobsets);
-
-      in filterTopLevel (collectDeps project.jobsets);
+      in mapAttrs (name: job: inputs2jobs job.inputs) project.jobsets;
 
           in pkgs.runCommand "project" {} ''
           mkdir -p $out
 
-          echo '${builtins.toJSON (project // { inherit deps; }) }' > $out/project.json
+          echo '${builtins.toJSON (project // { inherit graph; }) }' > $out/project.json
           echo '${builtins.toJSON inputsMap}' > $out/inputs.json
           echo '${builtins.toJSON outputsMap}' > $out/outputs.json
-          echo '${builtins.toJSON deps}' > $out/deps.json
+          echo '${builtins.toJSON graph}' > $out/graph.json
           echo "${concatStringsSep "\n" allOutputs}" > $out/allOutputs
         '';
 
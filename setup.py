@@ -17,6 +17,9 @@ setuptools.setup(
     long_description_content_type = "text/markdown",
     url = "https://github.com/markuskowa/fspx",
     packages = setuptools.find_packages(),
+    extras_require = {
+        'chunking': ['numpy'],
+    },
      entry_points={
         'console_scripts': ['fspx=fspx.main:main']
     },
@@ -0,0 +1,70 @@
+# SPDX-FileCopyrightText: 2022 Markus Kowalewski
+#
+# SPDX-License-Identifier: GPL-3.0-only
+
+'''Test project with the jobs pre -> a, b -> sum in a temporary directory
+'''
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from fspx import cas
+from fspx import fspx
+from fspx import hashcache
+from fspx import manifest
+
+
+def write_script(path: str, body: str) -> str:
+    with open(path, "w") as f:
+        f.write("#!/bin/sh\n" + body)
+    os.chmod(path, 0o755)
+
+    return path
+
+class ProjectTestCase(unittest.TestCase):
+    """Project with the jobs pre -> a, b -> sum
+    """
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.dir = tempfile.mkdtemp()
+        os.chdir(self.dir)
+
+        for d in [ fspx.cfgPath, "src", "scripts" ]:
+            os.makedirs(d)
+        with open("src/raw.dat", "w") as f:
+            f.write("1 2 3\n")
+
+        # project state is kept in module globals, relative to the project
+        fspx.manifests = manifest.ManifestStore(fspx.cfgPath)
+        fspx.hash_cache = hashcache.HashCache(os.path.join(fspx.cfgPath, "hashcache.json"))
+        cas._formats.clear()
+        cas._chunk_thresholds.clear()
+
+        check = write_script("scripts/check", 'cd "$1"; shift\nfor f in "$@"; do [ -f "$f" ] || exit 1; done\n')
+
+        self.jobsets = {}
+        for name, inputs, outputs, body in [
+                ("pre", [ "src/raw.dat" ], [ "data" ], "cat inputs/raw.dat > data\n"),
+                ("a", [ ":data" ], [ "a.dat" ], "cat inputs/data > a.dat; echo a >> a.dat\n"),
+                ("b", [ ":data" ], [ "b.dat" ], "cat inputs/data > b.dat; echo b >> b.dat\n"),
+                ("sum", [ ":a.dat", ":b.dat" ], [ "sum" ], "cat inputs/a.dat inputs/b.dat > sum\n") ]:
+            job_script = write_script("scripts/job-" + name, body)
+            self.jobsets[name] = {
+                'inputs': { i: None for i in inputs },
+                'outputs': outputs,
+                'jobLauncher': "",
+                'jobScript': os.path.abspath(job_script),
+                'runScript': os.path.abspath(write_script("scripts/run-" + name, 'cd "$1"\n$2 ' + os.path.abspath(job_script) + "\n")),
+                'checkScript': os.path.abspath(check),
+                'workdir': os.path.join(self.dir, "work", name),
+            }
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.dir)
@@ -0,0 +1,125 @@
+# SPDX-FileCopyrightText: 2022 Markus Kowalewski
+#
+# SPDX-License-Identifier: GPL-3.0-only
+
+'''Tests of the Slurm executor against the stand-ins in tests/slurm
+
+usage: python -m unittest discover tests
+'''
+
+import os
+import sys
+import time
+import unittest
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from fspx import fspx
+from fspx import executors
+
+from project import ProjectTestCase, write_script
+
+
+SLURM = os.path.join(os.path.abspath(os.path.dirname(__file__)), "slurm")
+
+class SlurmExecutorTest(ProjectTestCase):
+    """Runs the test project with the stand-ins for sbatch, squeue and scancel
+    """
+
+    def setUp(self):
+        super().setUp()
+        os.environ['FAKE_SLURM_DIR'] = self.dir
+
+    def executor(self) -> executors.SlurmExecutor:
+        return executors.SlurmExecutor(10, os.path.join(fspx.cfgPath, "batch"),
+                                       sbatch=os.path.join(SLURM, "sbatch"),
+                                       squeue=os.path.join(SLURM, "squeue"),
+                                       scancel=os.path.join(SLURM, "scancel"),
+                                       poll_interval=0.05)
+
+    def submitted(self) -> list[int]:
+        """Number of tasks of every submitted array job
+        """
+        with open("submitted") as f:
+            return [ int(line.split()[1]) + 1 for line in f ]
+
+    def in_queue(self, job_id: str) -> bool:
+        out = subprocess.run([ os.path.join(SLURM, "squeue"), "-h", "-j", job_id, "-o", "%i" ],
+                             stdout=subprocess.PIPE, text=True).stdout
+        return out.strip() != ""
+
+    def batch_files(self) -> list[str]:
+        return os.listdir(os.path.join(fspx.cfgPath, "batch"))
+
+    def test_dag(self):
+        ok = fspx.run_jobs(self.jobsets, [ "pre", "a", "b", "sum" ], "./dstore", executor=self.executor())
+        self.assertTrue(ok)
+
+        with open("outputs/sum") as f:
+            self.assertEqual(f.read(), "1 2 3\na\n1 2 3\nb\n")
+
+        # a and b are independent and submitted as one array
+        self.assertEqual(self.submitted(), [ 1, 2, 1 ])
+        self.assertEqual(self.batch_files(), [])
+
+        for name in self.jobsets:
+            self.assertTrue(fspx.check_job(name, self.jobsets[name], "./dstore"))
+
+    def test_failing_task(self):
+        write_script("scripts/job-b", "exit 1\n")
+
+        ok = fspx.run_jobs(self.jobsets, [ "pre", "a", "b", "sum" ], "./dstore", executor=self.executor())
+        self.assertFalse(ok)
+
+        # a has been imported, sum is not run after b has failed
+        self.assertTrue(os.path.exists("outputs/a.dat"))
+        self.assertFalse(os.path.lexists("outputs/b.dat"))
+        self.assertFalse(os.path.lexists("outputs/sum"))
+        self.assertEqual(self.submitted(), [ 1, 2 ])
+        self.assertEqual(self.batch_files(), [])
+
+    def test_prepare_error(self):
+        os.remove("src/raw.dat")
+
+        executor = self.executor()
+        task = fspx.JobTask("pre", self.jobsets['pre'], "./dstore", None, {})
+        executor.submit(task)
+
+        self.assertEqual(executor.running(), 1)
+        finished = executor.wait()
+        self.assertEqual(len(finished), 1)
+        self.assertIs(finished[0][0], task)
+        self.assertIsInstance(finished[0][1], FileNotFoundError)
+        self.assertEqual(executor.running(), 0)
+
+    def test_run_prepare_error(self):
+        os.remove("src/raw.dat")
+
+        ok = fspx.run_jobs(self.jobsets, [ "pre", "a", "b", "sum" ], "./dstore", executor=self.executor())
+        self.assertFalse(ok)
+        self.assertFalse(os.path.exists("submitted"))
+
+    def test_close_cancels(self):
+        write_script("scripts/job-pre", "sleep 60\n")
+
+        executor = self.executor()
+        executor.submit(fspx.JobTask("pre", self.jobsets['pre'], "./dstore", None, {}))
+        executor._submit_array()
+        executor.close()
+
+        with open("cancelled") as f:
+            self.assertEqual(f.read().split(), [ "1001" ])
+
+        self.assertEqual(executor.running(), 0)
+        self.assertEqual(self.batch_files(), [])
+
+        # the task has been killed
+        deadline = time.monotonic() + 5
+        while self.in_queue("1001") and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.assertFalse(self.in_queue("1001"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,150 @@
+# SPDX-FileCopyrightText: 2022 Markus Kowalewski
+#
+# SPDX-License-Identifier: GPL-3.0-only
+
+'''Tests of store migration and garbage collection
+
+usage: python -m unittest discover tests
+'''
+
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from fspx import cas
+from fspx import fspx
+
+from project import ProjectTestCase
+
+
+DSTORE = "./dstore"
+
+class StoreTest(ProjectTestCase):
+    """Store of the test project after a run
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.assertTrue(fspx.run_jobs(self.jobsets, [ "pre", "a", "b", "sum" ], DSTORE))
+
+    def objects(self) -> dict[str, str]:
+        """Store files: name -> path
+        """
+        return { f.name: f.path for f in cas.iter_objects(DSTORE) }
+
+    def empty_dirs(self) -> list[str]:
+        meta = cas.meta_dir(DSTORE)
+        return [ d for d, dirs, files in os.walk(DSTORE)
+                 if not dirs and not files and not d.startswith(meta) ]
+
+    def assert_links(self) -> None:
+        """All links resolve and all jobs are valid
+        """
+        with open("src/raw.dat") as f:
+            raw = f.read()
+        with open("outputs/sum") as f:
+            self.assertEqual(f.read(), raw + "a\n" + raw + "b\n")
+
+        for dir in [ "inputs", "outputs" ]:
+            for link in os.listdir(dir):
+                self.assertTrue(os.path.isfile(os.path.join(dir, link)), link)
+
+        for name in self.jobsets:
+            self.assertTrue(fspx.check_job(name, self.jobsets[name], DSTORE), name)
+
+    def rerun(self) -> None:
+        """Change the raw input and run again, the old files become garbage
+        """
+        with open("src/raw.dat", "w") as f:
+            f.write("4 5 6\n")
+        self.assertTrue(fspx.run_jobs(self.jobsets, [ "pre", "a", "b", "sum" ], DSTORE))
+
+    def test_migrate_round_trip(self):
+        before = self.objects()
+
+        self.assertEqual(cas.migrate_store(DSTORE, cas.FORMAT_SHARDED), len(before))
+        for name, path in self.objects().items():
+            self.assertEqual(path, os.path.join(DSTORE, name[0:2], name[2:4], name))
+        self.assert_links()
+
+        self.assertEqual(cas.migrate_store(DSTORE, cas.FORMAT_FLAT), len(before))
+        self.assertEqual(self.objects(), before)
+        self.assert_links()
+        self.assertEqual(self.empty_dirs(), [])
+
+    def test_migrate_interrupted(self):
+        before = self.objects()
+
+        # interrupt after the files of two hashes have been moved
+        move_gcroot = cas._move_gcroot
+        calls = []
+        def interrupt(*args):
+            calls.append(args)
+            if len(calls) > 2:
+                raise KeyboardInterrupt()
+            move_gcroot(*args)
+
+        with mock.patch.object(cas, "_move_gcroot", interrupt):
+            with self.assertRaises(KeyboardInterrupt):
+                cas.migrate_store(DSTORE, cas.FORMAT_SHARDED)
+        self.assert_links()
+
+        cas.migrate_store(DSTORE, cas.FORMAT_SHARDED)
+
+        # every file exists once, in the new layout
+        after = self.objects()
+        self.assertEqual(sorted(after), sorted(before))
+        for name, path in after.items():
+            self.assertEqual(path, os.path.join(DSTORE, name[0:2], name[2:4], name))
+        for root in cas.iter_gcroots(DSTORE):
+            self.assertEqual(root.path, os.path.join(DSTORE, "gcroots", root.name[0:2], root.name[2:4], root.name))
+        self.assert_links()
+        self.assertEqual(self.empty_dirs(), [])
+
+    def test_gc_dry_run_max_bytes(self):
+        self.rerun()
+
+        reachable, _ = cas.find_live_roots(DSTORE)
+        objects = self.objects()
+        garbage = { name: os.path.getsize(path) for name, path in objects.items() if not name in reachable }
+        # old raw.dat (same as data), a.dat, b.dat and sum
+        self.assertEqual(len(garbage), 4)
+
+        self.assertEqual(cas.clean_garbage(DSTORE, dry_run=True), (len(garbage), sum(garbage.values())))
+        self.assertEqual(self.objects(), objects)
+
+        # stops after the first file
+        files, size = cas.clean_garbage(DSTORE, max_bytes=1)
+        removed = set(objects) - set(self.objects())
+        self.assertEqual(files, 1)
+        self.assertEqual(len(removed), 1)
+        self.assertEqual(size, garbage[removed.pop()])
+
+        self.assertEqual(cas.clean_garbage(DSTORE), (len(garbage) - 1, sum(garbage.values()) - size))
+        self.assertEqual(cas.clean_garbage(DSTORE), (0, 0))
+        self.assert_links()
+
+    def test_gc_keeps_live_roots(self):
+        for format in [ cas.FORMAT_FLAT, cas.FORMAT_SHARDED ]:
+            with self.subTest(format=format):
+                cas.migrate_store(DSTORE, format)
+                self.rerun()
+
+                reachable, _ = cas.find_live_roots(DSTORE)
+                cas.clean_garbage(DSTORE)
+
+                self.assertEqual(set(self.objects()), reachable)
+                self.assertEqual(self.empty_dirs(), [])
+                self.assert_links()
+
+                # the first run again for the next layout
+                with open("src/raw.dat", "w") as f:
+                    f.write("1 2 3\n")
+                self.assertTrue(fspx.run_jobs(self.jobsets, [ "pre", "a", "b", "sum" ], DSTORE))
+
+
+if __name__ == '__main__':
+    unittest.main()